@@ -1,14 +1,18 @@
-from models import Product, Category
+from models import Product
+from activity.categories import get_category_id_by_name
+from activity.search import index_product
+from activity.thumbnails import store_image_variants
+from storage import store_blob
 
 
 def add_product_invoke(form, db, current_user):
     """
-    Updates a Product object with data from a form and commits changes to the database.
+    Updates a Product object with data from a form and writes the changes to the database session.
 
     Parameters:
     - product (Product): The Product object to update.
     - form (formProductForEdit): The form containing updated product data.
-    - db (SQLAlchemy): The database session object for committing changes.
+    - db (SQLAlchemy): The database session object for writing changes.
 
     Returns:
     None
@@ -21,18 +25,19 @@ def add_product_invoke(form, db, current_user):
     location = form.location.data
 
     # Find and assign the new category
-    category = db.session.execute(
-        db.select(Category).where(Category.name == form.category.data)
-    ).scalar()
+    category_id = get_category_id_by_name(db, form.category.data)
 
     image = form.image.data
     image_0 = image.read()  # Read the image file
     image_mimetype = image.mimetype  # Save the image's MIME type
 
-    product = Product(name=name, description=description, price=price, amount=amount, status=0, location=location, category=category, image=image_0, image_mimetype=image_mimetype)
+    product = Product(name=name, description=description, price=price, amount=amount, status=0, location=location, category_id=category_id, image_hash=store_blob(image_0), image_mimetype=image_mimetype)
+    store_image_variants(product, image_0)  # Card, detail and basket sizes
 
     db.session.add(product)
+    db.session.flush()  # Assigns the id used as the search index rowid
+    index_product(db, product)
 
-    # Commit changes to the database
-    db.session.commit()
+    # Write the changes; they are committed with the request
+    db.session.flush()
 
@@ -1,59 +1,316 @@
-from models import Cookie, BasketProduct
+import time
+from datetime import datetime, timezone
+
+from flask import g
+from sqlalchemy.dialects.sqlite import insert
+
+from models import Cookie, BasketProduct, Product
+
+# Badge counts cached per basket owner: {owner: (count, expires_at)}. The TTL
+# bounds staleness caused by other workers or by stock running out.
+BASKET_COUNT_TTL = 30
+BASKET_COUNT_CACHE_SIZE = 10000
+_basket_count_cache = {}
+
+# A guest's cookies.last_seen is refreshed at most this often (seconds), so
+# browsing costs one small write per day rather than one per request.
+COOKIE_TOUCH_INTERVAL = 24 * 60 * 60
+
+
+def basket_owner(current_user, session):
+    """
+    Identifies whose basket the current request works with.
+
+    Parameters:
+    current_user: The currently authenticated user (if logged in).
+    session: The session object holding the guest cookie ID.
+
+    Returns:
+    ("user", user_id), ("cookie", cookie_id), or None for a guest without a basket.
+    """
+    if current_user.is_authenticated:
+        return "user", current_user.id
+    if "user_id" in session:
+        return "cookie", session["user_id"]
+    return None
+
+
+def basket_product_owner(basket_product):
+    """
+    Returns the owner key of an existing basket line.
+
+    Parameters:
+    basket_product: The BasketProduct object.
+
+    Returns:
+    ("user", user_id) or ("cookie", cookie_id).
+    """
+    if basket_product.user_id is not None:
+        return "user", basket_product.user_id
+    return "cookie", basket_product.cookie_id
+
+
+def owner_filter(owner):
+    """
+    Builds the WHERE clause selecting the basket lines of an owner.
+
+    Parameters:
+    owner: The owner key returned by basket_owner.
+
+    Returns:
+    A SQLAlchemy boolean expression.
+    """
+    kind, owner_id = owner
+    if kind == "user":
+        return BasketProduct.user_id == owner_id
+    return BasketProduct.cookie_id == owner_id
+
+
+def count_basket_products(db, owner):
+    """
+    Counts the basket lines of an owner whose product is in stock, in a single query.
+
+    Parameters:
+    db: The database session object used for querying.
+    owner: The owner key returned by basket_owner.
+
+    Returns:
+    The number of in-stock basket lines.
+    """
+    return db.session.execute(
+        db.select(db.func.count(BasketProduct.id))
+        .join(Product, Product.id == BasketProduct.product_id)
+        .where(owner_filter(owner), Product.amount >= 1)
+    ).scalar()
+
+
+def get_basket_count(db, owner):
+    """
+    Returns the basket badge count, memoized for the request and cached per owner.
+
+    Parameters:
+    db: The database session object used for querying.
+    owner: The owner key returned by basket_owner, or None.
+
+    Returns:
+    The number of in-stock basket lines.
+    """
+    if owner is None:
+        return 0
+    memo = g.setdefault("basket_counts", {})
+    if owner in memo:
+        return memo[owner]
+
+    cached = _basket_count_cache.get(owner)
+    if cached is not None and cached[1] > time.monotonic():
+        count = cached[0]
+    else:
+        count = count_basket_products(db, owner)
+        if len(_basket_count_cache) >= BASKET_COUNT_CACHE_SIZE:
+            _basket_count_cache.pop(next(iter(_basket_count_cache)), None)  # Drop the oldest entry
+        _basket_count_cache[owner] = (count, time.monotonic() + BASKET_COUNT_TTL)
+    memo[owner] = count
+    return count
+
+
+def invalidate_basket_count(owner):
+    """
+    Forgets the cached badge count of an owner after their basket changed.
+
+    The owner is remembered for the request too: the change only becomes
+    visible to other requests once it is committed, so the count is
+    forgotten again after the commit (see forget_committed_basket_counts).
+
+    Parameters:
+    owner: The owner key returned by basket_owner or basket_product_owner.
+
+    Returns:
+    None
+    """
+    _basket_count_cache.pop(owner, None)
+    g.get("basket_counts", {}).pop(owner, None)
+    g.setdefault("changed_baskets", set()).add(owner)
+
+
+def forget_committed_basket_counts():
+    """
+    Drops the cached badge counts of the baskets changed by the transaction just committed.
+
+    Returns:
+    None
+    """
+    for owner in g.pop("changed_baskets", ()):
+        _basket_count_cache.pop(owner, None)
 
 
 def get_or_create_session_cookie(db, session):
     """
-    Retrieves or creates a session-based cookie for an anonymous user.
+    Retrieves or creates the cookie row backing an anonymous user's basket.
+
+    Guest baskets are created lazily: only adding a product calls this, so
+    browsing anonymously never writes to the database. The new row is
+    flushed, not committed; it is committed with the basket line.
 
     Parameters:
-    db: The database session object for committing changes.
+    db: The database session object.
     session: The session object used to store the cookie ID.
 
     Returns:
     The cookie ID for the session.
     """
     # Check if 'user_id' exists in the session and if the cookie exists in the database
-    if "user_id" not in session or not db.session.execute(
-            db.select(Cookie).where(Cookie.id == session["user_id"])).scalar():
+    if "user_id" not in session or db.session.get(Cookie, session["user_id"]) is None:
         # If not, create a new cookie for the session
-        new_cookie = Cookie()
+        new_cookie = Cookie(last_seen=datetime.now(timezone.utc))
         db.session.add(new_cookie)
-        db.session.commit()  # Commit to save the new cookie to the database
+        db.session.flush()  # Assigns the ID
         session["user_id"] = new_cookie.id  # Save the new cookie ID in the session
+        session["cookie_seen"] = time.time()
     return session["user_id"]
 
 
-def get_basket_products_by_cookie(db, cookie_id):
+def touch_session_cookie(db, session):
     """
-    Fetches basket products associated with a session-based cookie.
+    Records that a guest with a basket is still around, so housekeeping keeps the basket.
 
     Parameters:
-    db: The database session object used for querying.
-    cookie_id: The ID of the cookie to retrieve basket products for.
+    db: The database session object.
+    session: The session object holding the guest cookie ID.
 
     Returns:
-    A list of BasketProduct objects associated with the given cookie ID.
+    None
     """
-    # Query for products in the basket based on the cookie ID
-    return db.session.execute(
-        db.select(BasketProduct).where(BasketProduct.cookie_id == cookie_id)
-    ).scalars().all()
+    if "user_id" not in session or time.time() - session.get("cookie_seen", 0) < COOKIE_TOUCH_INTERVAL:
+        return
+    db.session.execute(
+        db.update(Cookie).where(Cookie.id == session["user_id"]).values(last_seen=datetime.now(timezone.utc))
+    )
+    session["cookie_seen"] = time.time()
+
+
+def owner_column(owner):
+    """
+    Returns the basket column holding the owner's ID.
+
+    Parameters:
+    owner: The owner key returned by basket_owner.
+
+    Returns:
+    BasketProduct.user_id or BasketProduct.cookie_id.
+    """
+    return BasketProduct.user_id if owner[0] == "user" else BasketProduct.cookie_id
 
 
-def get_basket_products_by_user(db, user_id):
+def add_to_basket(db, owner, product_id, amount):
     """
-    Fetches basket products for an authenticated user.
+    Adds a quantity of a product to a basket in a single statement.
+
+    INSERT ... SELECT ... ON CONFLICT DO UPDATE either creates the line or
+    increases it, and both branches check the stock in the same statement,
+    so concurrent clicks can never push a line past the stock. For guests
+    the statement also checks that the basket still exists. Not committed.
+
+    Parameters:
+    db: The database session object.
+    owner: The owner key returned by basket_owner.
+    product_id: The ID of the product to add.
+    amount: The quantity to add (positive).
+
+    Returns:
+    bool: False if the product does not exist, there is not enough stock, or the guest basket is gone.
+    """
+    column = owner_column(owner)
+    guard = [Product.id == product_id, Product.amount >= amount]
+    if owner[0] == "cookie":
+        guard.append(db.select(Cookie.id).where(Cookie.id == owner[1]).exists())
+    stock = db.select(Product.amount).where(Product.id == product_id).scalar_subquery()
+
+    statement = insert(BasketProduct).from_select(
+        ["product_id", column.key, "amount"],
+        db.select(Product.id, db.literal(owner[1]), db.literal(amount)).where(*guard)
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[column, BasketProduct.product_id],
+        set_={"amount": BasketProduct.amount + statement.excluded.amount},
+        where=BasketProduct.amount + statement.excluded.amount <= stock
+    )
+    return db.session.execute(statement).rowcount == 1
+
+
+def merge_guest_basket(db, session, user_id):
+    """
+    Moves a guest's basket into the basket of the user who just logged in.
+
+    One upsert copies every guest line into the user's basket, adding to
+    the lines the user already has. Merged quantities are capped at the
+    stock (but never lower what the user already had). The guest lines and
+    cookie are deleted after. Not committed.
+
+    Parameters:
+    db: The database session object.
+    session: The session object holding the guest cookie ID; the ID is removed from it.
+    user_id: The ID of the user the basket is merged into.
+
+    Returns:
+    The number of guest lines merged.
+    """
+    cookie_id = session.pop("user_id", None)
+    session.pop("cookie_seen", None)
+    if cookie_id is None:
+        return 0
+
+    guest = db.aliased(BasketProduct)
+    # SQLAlchemy does not correlate subqueries inside ON CONFLICT, so the line's column is spelled out
+    stock = (
+        db.select(Product.amount)
+        .where(Product.id == db.literal_column('"basketProducts".product_id'))
+        .scalar_subquery()
+    )
+    statement = insert(BasketProduct).from_select(
+        ["product_id", "user_id", "amount"],
+        db.select(guest.product_id, db.literal(user_id), db.func.min(guest.amount, Product.amount))
+        .join(Product, Product.id == guest.product_id)
+        .where(guest.cookie_id == cookie_id, Product.amount > 0)
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[BasketProduct.user_id, BasketProduct.product_id],
+        set_={"amount": db.func.max(BasketProduct.amount, db.func.min(BasketProduct.amount + statement.excluded.amount, stock))}
+    ))
+
+    merged = db.session.execute(
+        db.delete(BasketProduct).where(BasketProduct.cookie_id == cookie_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.execute(
+        db.delete(Cookie).where(Cookie.id == cookie_id).execution_options(synchronize_session=False)
+    )
+
+    invalidate_basket_count(("cookie", cookie_id))
+    invalidate_basket_count(("user", user_id))
+    return merged
+
+
+def load_basket_products(db, owner):
+    """
+    Loads the basket lines of an owner together with their products in one round trip.
+
+    Every basket view and the checkout go through this loader, so touching
+    basket_product.product afterwards never triggers a lazy SELECT.
 
     Parameters:
     db: The database session object used for querying.
-    user_id: The ID of the authenticated user to retrieve basket products for.
+    owner: The owner key returned by basket_owner, or None.
 
     Returns:
-    A list of BasketProduct objects associated with the given user ID.
+    A list of BasketProduct objects, in the order they were added.
     """
-    # Query for products in the basket based on the user ID
+    if owner is None:
+        return []
     return db.session.execute(
-        db.select(BasketProduct).where(BasketProduct.user_id == user_id)
+        db.select(BasketProduct)
+        .where(owner_filter(owner))
+        .options(db.joinedload(BasketProduct.product))
+        .order_by(BasketProduct.id)
     ).scalars().all()
 
 
@@ -69,12 +326,77 @@ def get_products_in_basket(db, current_user, session):
     Returns:
     A list of products found in the basket, either for the logged-in user or the session-based user.
     """
-    if not current_user.is_authenticated:
-        # Handle session-based basket for anonymous users
-        cookie_id = get_or_create_session_cookie(db, session)  # Retrieve or create session cookie
-        products = get_basket_products_by_cookie(db, cookie_id)  # Get products for session-based user
-    else:
-        # Handle basket for authenticated users
-        products = get_basket_products_by_user(db, current_user.id)  # Get products for logged-in user
+    # A guest who never added anything has no basket yet, and gets none here
+    return load_basket_products(db, basket_owner(current_user, session))
+
+
+def read_basket_changes(payload):
+    """
+    Validates the body of a basket update request.
+
+    Parameters:
+    payload: The decoded JSON body, e.g. {"changes": [{"id": 12, "amount": 3}]}.
+
+    Returns:
+    A dict {basket_product_id: new_amount}, or None if the body is malformed.
+    A later change of the same line wins; an amount of 0 removes the line.
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get("changes"), list):
+        return None
+    changes = {}
+    for change in payload["changes"]:
+        if not isinstance(change, dict):
+            return None
+        line_id, amount = change.get("id"), change.get("amount")
+        # bool is an int subclass; reject it explicitly
+        if type(line_id) is not int or type(amount) is not int or amount < 0:
+            return None
+        changes[line_id] = amount
+    return changes or None
+
+
+def apply_basket_changes(db, owner, changes):
+    """
+    Sets the quantities of several basket lines; the request commits them as one transaction.
+
+    An amount of 0 removes the line. Increases are capped at the product's
+    available stock, like /addOne, but a line is never lowered or removed
+    for lack of stock: Product.amount excludes reserved stock, which may
+    come back, and the checkout pre-flight reports any shortage. Every line
+    must belong to the owner, otherwise nothing is changed.
+
+    Parameters:
+    db: The database session object.
+    owner: The owner key returned by basket_owner, or None.
+    changes: The {basket_product_id: new_amount} dict returned by read_basket_changes.
+
+    Returns:
+    - (0, result): result holds the changed lines ("id", "amount", "total"), the
+      basket "total" and the badge "count".
+    - (1, None): if a line does not exist or belongs to another basket.
+    """
+    # One query loads every line of the basket with its product
+    basket_products = {basket_product.id: basket_product for basket_product in load_basket_products(db, owner)}
+    if not set(changes) <= set(basket_products):
+        return 1, None
+
+    lines = []
+    for line_id, amount in changes.items():
+        basket_product = basket_products[line_id]
+        if amount == 0:
+            db.session.delete(basket_product)
+            del basket_products[line_id]
+        elif amount > basket_product.amount:
+            basket_product.amount = min(amount, max(basket_product.amount, basket_product.product.amount))
+        else:
+            basket_product.amount = amount
+        stored = basket_product.amount if line_id in basket_products else 0
+        lines.append({"id": line_id, "amount": stored, "total": stored * basket_product.product.price})
+    db.session.flush()
 
-    return products
+    invalidate_basket_count(owner)
+    return 0, {
+        "lines": lines,
+        "total": sum(bp.amount * bp.product.price for bp in basket_products.values()),
+        "count": get_basket_count(db, owner),
+    }
@@ -0,0 +1,189 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+
+from models import Product
+
+MAX_PAGE_SIZE = 100
+
+# items: the rows of the page; next_cursor/prev_cursor: opaque tokens for the
+# neighbouring pages, or None at either end of the listing
+Page = namedtuple("Page", ["items", "next_cursor", "prev_cursor"])
+
+
+def select_catalog_products(db):
+    """
+    Builds the base SELECT used by every product listing.
+
+    The image lives in the blob store, so listings only read lightweight
+    columns. Category names come from the category cache, not a join.
+
+    Parameters:
+    db: The database session object.
+
+    Returns:
+    A SELECT statement for Product rows, ready for further filtering.
+    """
+    return db.select(Product)
+
+
+def select_warehouse_products(db):
+    """
+    Builds the SELECT for the warehouse table, loading only the columns it shows.
+
+    Parameters:
+    db: The database session object.
+
+    Returns:
+    A SELECT statement for Product rows.
+    """
+    return db.select(Product).options(
+        db.load_only(Product.id, Product.name, Product.description, Product.price, Product.amount)
+    )
+
+
+def encode_cursor(values):
+    """
+    Encodes the sort key of a row as an opaque, URL-safe cursor.
+
+    Parameters:
+    values: The list of key values, e.g. [price, id].
+
+    Returns:
+    The cursor string.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor produced by encode_cursor.
+
+    Parameters:
+    cursor: The cursor string from the query string.
+
+    Returns:
+    The list of key values, or None if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(values, list) or not all(isinstance(value, (int, float, str)) for value in values):
+        return None
+    return values
+
+
+def read_page_request(request, per_page):
+    """
+    Reads the pagination parameters (after, before, per_page) from the query string.
+
+    Parameters:
+    request: The request object containing query parameters.
+    per_page: The page size used when the client does not ask for one.
+
+    Returns:
+    A dict of keyword arguments for paginate_keyset.
+    """
+    per_page = request.args.get("per_page", per_page, type=int)
+    return {
+        "after": request.args.get("after"),
+        "before": request.args.get("before"),
+        "per_page": max(1, min(per_page, MAX_PAGE_SIZE)),
+    }
+
+
+def paginate_keyset(db, query, sort_column, after=None, before=None, per_page=24, descending=False):
+    """
+    Fetches one page of a query using keyset (cursor) pagination on (sort_column, id).
+
+    Unlike OFFSET, the cost of a page does not grow with its position: the
+    database seeks straight to the cursor through the (sort key, id) index.
+
+    Parameters:
+    db: The database session object.
+    query: The SELECT statement for Product rows, without ORDER BY.
+    sort_column: The column or SQL expression to order by; Product.id is always the tie-breaker.
+    after: Cursor of the last row of the previous page (go forward).
+    before: Cursor of the first row of the next page (go backward).
+    per_page: The number of rows per page.
+    descending: Whether the listing is ordered from the largest key down.
+
+    Returns:
+    A Page with the rows and the cursors of the neighbouring pages.
+    """
+    columns = [sort_column] if sort_column is Product.id else [sort_column, Product.id]
+    key = db.tuple_(*columns)
+
+    def row_key(row):
+        return list(row[1:])
+
+    cursor = decode_cursor(before) if before else decode_cursor(after) if after else None
+    if cursor is not None and len(cursor) != len(columns):
+        cursor = None
+    backward = bool(before) and cursor is not None
+
+    # Walking backward is the same walk in the opposite direction, reversed afterwards
+    ascending = descending == backward
+    if cursor is not None:
+        query = query.where(key > db.tuple_(*cursor) if ascending else key < db.tuple_(*cursor))
+    query = query.order_by(*[column.asc() if ascending else column.desc() for column in columns])
+
+    # The key values ride along with each row, so computed keys (e.g. search rank) work too
+    rows = db.session.execute(query.add_columns(*columns).limit(per_page + 1)).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+
+    if not rows:
+        return Page([], None, None)
+    items = [row[0] for row in rows]
+    if backward:
+        next_cursor = encode_cursor(row_key(rows[-1]))
+        prev_cursor = encode_cursor(row_key(rows[0])) if has_more else None
+    else:
+        next_cursor = encode_cursor(row_key(rows[-1])) if has_more else None
+        prev_cursor = encode_cursor(row_key(rows[0])) if cursor is not None else None
+    return Page(items, next_cursor, prev_cursor)
+
+
+def page_url(url_for, endpoint, args, **cursor):
+    """
+    Builds the URL of a neighbouring page, keeping the current filters.
+
+    Parameters:
+    url_for: Flask's url_for function.
+    endpoint: The endpoint of the listing.
+    args: The current query string arguments (request.args).
+    cursor: Either after=<cursor> or before=<cursor>.
+
+    Returns:
+    The URL string.
+    """
+    params = {name: values for name, values in args.to_dict(flat=False).items() if name not in ("after", "before")}
+    return url_for(endpoint, **params, **cursor)
+
+
+def serialize_product(url_for, product, category_names):
+    """
+    Converts a product into the dict returned by the JSON catalog API.
+
+    Parameters:
+    url_for: Flask's url_for function.
+    product: The Product object.
+    category_names: The id -> name mapping from the category cache.
+
+    Returns:
+    A JSON-serialisable dict.
+    """
+    return {
+        "id": product.id,
+        "name": product.name,
+        "price": product.price,
+        "amount": product.amount,
+        "category": category_names.get(product.category_id),
+        "url": url_for("one_product", num=product.id),
+        "image": url_for("product_image", product_id=product.id, size="card", v=product.image_hash),
+    }
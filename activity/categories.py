@@ -0,0 +1,155 @@
+import threading
+from collections import namedtuple
+
+from flask import g
+from sqlalchemy.dialects.sqlite import insert
+
+from models import CacheVersion, Category
+
+CachedCategory = namedtuple("CachedCategory", ["id", "name"])
+
+# Categories almost never change, so every worker keeps them in memory. The
+# cacheVersions row is bumped in the same transaction as any category change;
+# a worker reloads when the version it has differs from the one in the DB.
+CATEGORIES_CACHE_KEY = "categories"
+_lock = threading.Lock()
+_cache = {"version": None, "categories": [], "by_id": {}, "by_name": {}}
+
+
+def get_categories_version(db):
+    """
+    Reads the current version of the category list from the database.
+
+    Parameters:
+    db: The database session object used for querying.
+
+    Returns:
+    The version number (0 if categories were never changed).
+    """
+    version = db.session.execute(
+        db.select(CacheVersion.version).where(CacheVersion.name == CATEGORIES_CACHE_KEY)
+    ).scalar()
+    return version or 0
+
+
+def bump_categories_version(db):
+    """
+    Marks the category list as changed, for this and every other worker process.
+
+    Must be called in the same transaction as the change itself.
+
+    Parameters:
+    db: The database session object.
+
+    Returns:
+    None
+    """
+    db.session.execute(
+        insert(CacheVersion)
+        .values(name=CATEGORIES_CACHE_KEY, version=1)
+        .on_conflict_do_update(index_elements=[CacheVersion.name], set_={"version": CacheVersion.version + 1})
+    )
+    with _lock:
+        _cache["version"] = None
+    g.pop("categories_version", None)
+
+
+def load_categories(db):
+    """
+    Returns the in-memory category cache, reloading it if another process changed the categories.
+
+    The version is checked at most once per request.
+
+    Parameters:
+    db: The database session object used for querying.
+
+    Returns:
+    The cache dict with "categories", "by_id" and "by_name".
+    """
+    if "categories_version" not in g:
+        g.categories_version = get_categories_version(db)
+    version = g.categories_version
+
+    with _lock:
+        if _cache["version"] == version:
+            return _cache
+
+    rows = db.session.execute(db.select(Category.id, Category.name).order_by(Category.id)).all()
+    categories = [CachedCategory(row.id, row.name) for row in rows]
+    with _lock:
+        _cache.update(
+            version=version,
+            categories=categories,
+            by_id={category.id: category.name for category in categories},
+            by_name={category.name: category.id for category in categories},
+        )
+        return _cache
+
+
+def get_categories(db):
+    """
+    Returns every category, from the cache.
+
+    Parameters:
+    db: The database session object used for querying.
+
+    Returns:
+    A list of CachedCategory tuples (id, name).
+    """
+    return load_categories(db)["categories"]
+
+
+def get_category_names(db):
+    """
+    Returns the id -> name mapping of all categories, from the cache.
+
+    Parameters:
+    db: The database session object used for querying.
+
+    Returns:
+    A dict mapping category IDs to names.
+    """
+    return load_categories(db)["by_id"]
+
+
+def get_category_id_by_name(db, name):
+    """
+    Looks a category ID up by name, from the cache.
+
+    Parameters:
+    db: The database session object used for querying.
+    name: The category name.
+
+    Returns:
+    The category ID, or None if there is no such category.
+    """
+    return load_categories(db)["by_name"].get(name)
+
+
+def get_category_choices(db):
+    """
+    Builds the (value, label) choices of the category select fields.
+
+    Parameters:
+    db: The database session object used for querying.
+
+    Returns:
+    A list of (name, name) tuples.
+    """
+    return [(category.name, category.name) for category in get_categories(db)]
+
+
+def add_category(db, name):
+    """
+    Creates a category and invalidates the category cache.
+
+    Parameters:
+    db: The database session object for writing changes.
+    name: The name of the new category.
+
+    Returns:
+    None
+    """
+    db.session.add(Category(name=name))
+    bump_categories_version(db)
+    db.session.flush()
@@ -1,4 +1,5 @@
-from models import Category
+from models import Category, Product
+from activity.categories import get_category_id_by_name, bump_categories_version
 
 
 def find_category_by_name(db, category_name):
@@ -12,20 +13,25 @@ def find_category_by_name(db, category_name):
     Returns:
     The Category object if found, otherwise None.
     """
-    return db.session.execute(db.select(Category).where(Category.name == category_name)).scalar()
+    category_id = get_category_id_by_name(db, category_name)
+    return db.session.get(Category, category_id) if category_id is not None else None
 
 
-def category_has_products(category):
+def category_has_products(db, category):
     """
     Checks if the category has any associated products.
 
     Parameters:
+    db: The database session object used for querying.
     category: The Category object to check.
 
     Returns:
     True if the category has products, otherwise False.
     """
-    return bool(category.products)  # Assuming 'category.products' is a relationship in the model
+    # An EXISTS probe instead of loading every product of the category
+    return db.session.execute(
+        db.select(db.exists().where(Product.category_id == category.id))
+    ).scalar()
 
 
 def delete_category(db, category):
@@ -33,14 +39,15 @@ def delete_category(db, category):
     Deletes the given category from the database.
 
     Parameters:
-    db: The database session object for committing changes.
+    db: The database session object for writing changes.
     category: The Category object to delete.
 
     Returns:
     None
     """
     db.session.delete(category)
-    db.session.commit()
+    bump_categories_version(db)
+    db.session.flush()
 
 
 def invoke_delete_category(db, form):
@@ -48,7 +55,7 @@ def invoke_delete_category(db, form):
     Handles the deletion of a category based on form data. Ensures that no products are associated with the category before deletion.
 
     Parameters:
-    db: The database session object for querying and committing changes.
+    db: The database session object for querying and writing changes.
     form: The form object containing the category data (e.g., category name).
 
     Returns:
@@ -69,7 +76,7 @@ def invoke_delete_category(db, form):
         return 1, alerts
 
     # Check if the category has associated products
-    if category_has_products(category):
+    if category_has_products(db, category):
         alerts.append("You have to delete items with this category before deleting the category.")
         return 1, alerts
 
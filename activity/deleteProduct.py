@@ -1,4 +1,5 @@
 from models import Product, BasketProduct
+from activity.search import unindex_product
 
 
 def find_product_by_id(db, product_id):
@@ -36,7 +37,7 @@ def delete_basket_products(db, basket_products):
     Deletes all basket products passed in the list.
 
     Parameters:
-    db: The database session object for committing changes.
+    db: The database session object for writing changes.
     basket_products: A list of BasketProduct objects to delete.
 
     Returns:
@@ -51,7 +52,7 @@ def delete_product(db, product):
     Deletes a product from the database.
 
     Parameters:
-    db: The database session object for committing changes.
+    db: The database session object for writing changes.
     product: The Product object to delete.
 
     Returns:
@@ -65,7 +66,7 @@ def invoke_delete_product(db, num):
     Deletes a product and its associated basket products from the database.
 
     Parameters:
-    db: The database session object for querying and committing changes.
+    db: The database session object for querying and writing changes.
     num: The ID of the product to delete.
 
     Returns:
@@ -78,8 +79,9 @@ def invoke_delete_product(db, num):
     basket_products = find_basket_products_by_product_id(db, product.id)
     delete_basket_products(db, basket_products)
 
-    # Delete the product itself
+    # Delete the product itself, and drop it from the search index
+    unindex_product(db, product.id)
     delete_product(db, product)
 
-    # Commit all changes to the database
-    db.session.commit()
+    # Write all changes; they are committed with the request
+    db.session.flush()
@@ -1,37 +1,83 @@
-from models import Product, Category
+from models import Product
+from activity.categories import get_category_id_by_name
+from activity.search import index_product
+from activity.thumbnails import store_image_variants
+from storage import store_blob
+
+def adjust_product_amount(db, product_id, amount_seen, amount):
+    """
+    Applies an edit of the available amount as a change relative to what the editor saw.
+
+    Product.amount is the stock left after active reservations, and
+    checkouts keep changing it. Writing the edited value as is would undo
+    reservations made while the form was open, and give their stock back a
+    second time when they are released. Instead the difference between the
+    edited and the seen value is added, in one conditional UPDATE that never
+    takes the amount below zero.
+
+    Parameters:
+    - db (SQLAlchemy): The database session object.
+    - product_id (int): The ID of the product.
+    - amount_seen (int): The available amount the form was rendered with.
+    - amount (int): The available amount entered in the form.
+
+    Returns:
+    bool: False if the reservations made since then leave too little stock for the change.
+    """
+    change = amount - amount_seen
+    if change == 0:
+        return True
+    return db.session.execute(
+        db.update(Product)
+        .where(Product.id == product_id, Product.amount + change >= 0)
+        .values(amount=Product.amount + change)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
 
 def update_product_with_form_data(product, form, db):
     """
-    Updates a Product object with data from a form and commits changes to the database.
+    Updates a Product object with data from a form and writes the changes to the database session.
 
     Parameters:
     - product (Product): The Product object to update.
     - form (formProductForEdit): The form containing updated product data.
-    - db (SQLAlchemy): The database session object for committing changes.
+    - db (SQLAlchemy): The database session object for writing changes.
 
     Returns:
-    None
+    list: Alerts for the editor; nothing is changed when there are any.
     """
+    try:
+        amount_seen = int(form.amount_seen.data)
+    except (TypeError, ValueError):
+        return ["Formularz jest nieaktualny, odśwież stronę."]
+    if not adjust_product_amount(db, product.id, amount_seen, form.amount.data):
+        return ["Część towaru została w międzyczasie zarezerwowana, odśwież stronę i popraw ilość."]
+    db.session.refresh(product, ["amount"])
+
     # Update product fields with form data
     product.name = form.name.data
     product.description = form.description.data
     product.price = form.price.data
-    product.amount = form.amount.data
     product.location = form.location.data
 
     # Find and assign the new category
-    product.category = db.session.execute(
-        db.select(Category).where(Category.name == form.category.data)
-    ).scalar()
+    product.category_id = get_category_id_by_name(db, form.category.data)
 
     # If a new image was uploaded, update the product's image
     if form.image.data:
         image = form.image.data
-        product.image = image.read()  # Read the image file
+        image_0 = image.read()  # Read the image file
+        product.image_hash = store_blob(image_0)  # Write it to the blob store
         product.image_mimetype = image.mimetype  # Save the image's MIME type
+        store_image_variants(product, image_0)  # Regenerate the size variants
+
+    # Keep the search index in step with the new name and description
+    index_product(db, product)
 
-    # Commit changes to the database
-    db.session.commit()
+    # Write the changes; they are committed with the request
+    db.session.flush()
+    return []
 
 
 def find_product_by_id(db, product_id):
@@ -53,14 +99,14 @@ def invoke_edit_product(db, product_id, form):
     Handles the process of editing a product by updating it with data from a form.
 
     Parameters:
-    - db (SQLAlchemy): The database session object for querying and committing changes.
+    - db (SQLAlchemy): The database session object for querying and writing changes.
     - product_id (int): The ID of the Product object to be edited.
     - form (formProductForEdit): The form containing updated data to apply to the product.
 
     Returns:
-    None
+    list: Alerts for the editor, empty if the product was updated.
     """
     # Find the product by its ID
     product = db.get_or_404(Product, product_id)
     # Update the product with form data
-    update_product_with_form_data(product, form, db)
+    return update_product_with_form_data(product, form, db)
@@ -0,0 +1,97 @@
+from flask import send_file
+
+from models import Product, ProductImageVariant
+from storage import blob_path
+
+# URLs versioned with the original's content hash (?v=<hash>) never change meaning
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def get_product_image(db, product_id):
+    """
+    Fetches the content hash and MIME type of a product's original image.
+
+    Parameters:
+    db: The database session object used for querying.
+    product_id: The ID of the product whose image is requested.
+
+    Returns:
+    A tuple (image_hash, image_mimetype), or None if the product does not exist.
+    """
+    return db.session.execute(
+        db.select(Product.image_hash, Product.image_mimetype).where(Product.id == product_id)
+    ).first()
+
+
+def get_product_image_variant(db, product_id, size):
+    """
+    Fetches the content hash and MIME type of one size variant of a product image.
+
+    Parameters:
+    db: The database session object used for querying.
+    product_id: The ID of the product whose image is requested.
+    size: The variant name (see activity.thumbnails.IMAGE_VARIANTS).
+
+    Returns:
+    A tuple (image_hash, image_mimetype), or None if the variant was not generated.
+    """
+    return db.session.execute(
+        db.select(ProductImageVariant.image_hash, ProductImageVariant.image_mimetype)
+        .where(ProductImageVariant.product_id == product_id, ProductImageVariant.size == size)
+    ).first()
+
+
+def build_image_response(image_hash, image_mimetype, request, max_age, immutable=False):
+    """
+    Builds a cacheable HTTP response streaming an image from the blob store.
+
+    The content hash doubles as a strong ETag, so a revalidating browser gets
+    a 304 without the image being read. The file itself goes out through
+    the WSGI file wrapper (sendfile) or X-Sendfile when USE_X_SENDFILE is on.
+
+    Parameters:
+    image_hash: The SHA-256 hex digest of the image.
+    image_mimetype: The MIME type of the image.
+    request: The HTTP request object (used for If-None-Match handling).
+    max_age: How many seconds the browser may reuse the image without revalidating.
+    immutable: Whether the URL is versioned with the current content hash.
+
+    Returns:
+    A Flask response object, with status 200 or 304.
+    """
+    response = send_file(
+        blob_path(image_hash),
+        mimetype=image_mimetype,
+        etag=image_hash,
+        max_age=IMMUTABLE_MAX_AGE if immutable else max_age,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = immutable
+    return response
+
+
+def invoke_product_image(db, product_id, request, max_age, size=None):
+    """
+    Serves the image of a product, honouring conditional requests.
+
+    Parameters:
+    db: The database session object used for querying.
+    product_id: The ID of the product whose image is requested.
+    request: The HTTP request object.
+    max_age: Cache lifetime in seconds for the Cache-Control header.
+    size: Optional variant name. Falls back to the original when the variant is missing.
+
+    Returns:
+    A Flask response object, or None if the product does not exist.
+    """
+    original = get_product_image(db, product_id)
+    if original is None:
+        return None
+    row = get_product_image_variant(db, product_id, size) if size else None
+    # Variants are versioned by the hash of the original they were made from. The
+    # original standing in for a missing variant is not: once the variant is
+    # generated, the same URL serves other bytes.
+    immutable = request.args.get("v") == original.image_hash and (size is None or row is not None)
+    row = row or original
+    return build_image_response(row.image_hash, row.image_mimetype, request, max_age, immutable)
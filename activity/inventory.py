@@ -0,0 +1,153 @@
+import secrets
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from models import Product, StockReservation
+
+# Product.amount is the stock still available for sale: a checkout takes its
+# quantities out with a conditional UPDATE when the Stripe session is
+# created, and they are put back if the reservation is released.
+#
+# A reservation outlives its Stripe session by this much, so that a payment
+# completed in the last second is still matched to its reservation.
+RESERVATION_GRACE = timedelta(minutes=5)
+
+
+def reserve_stock(db, quantities, ttl):
+    """
+    Atomically takes the quantities of a checkout out of stock.
+
+    Every product is decremented with UPDATE ... WHERE amount >= quantity,
+    so concurrent checkouts can never oversell and no lock is held beyond
+    the statement. Either every product is reserved or none is. Not
+    committed; commit before calling Stripe.
+
+    Parameters:
+    db: The database session object.
+    quantities: {product_id: quantity} for the checkout.
+    ttl: How long the Stripe session stays open, as a timedelta.
+
+    Returns:
+    A tuple (token, shortages): the reservation token, or None when
+    something could not be reserved, and the list of product ids whose
+    stock was insufficient.
+    """
+    shortages = []
+    savepoint = db.session.begin_nested()
+    # A fixed order keeps concurrent checkouts from waiting on each other in a cycle
+    for product_id in sorted(quantities):
+        result = db.session.execute(
+            db.update(Product)
+            .where(Product.id == product_id, Product.amount >= quantities[product_id])
+            .values(amount=Product.amount - quantities[product_id])
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            shortages.append(product_id)
+    if shortages:
+        savepoint.rollback()
+        return None, shortages
+
+    token = secrets.token_urlsafe(16)
+    now = datetime.now(timezone.utc)
+    db.session.add_all([
+        StockReservation(token=token, product_id=product_id, amount=amount, status="active",
+                         created_at=now, expires_at=now + ttl + RESERVATION_GRACE)
+        for product_id, amount in quantities.items()
+    ])
+    savepoint.commit()
+    return token, []
+
+
+def restock(db, released):
+    """
+    Puts released quantities back into stock with a single UPDATE.
+
+    Parameters:
+    db: The database session object.
+    released: Rows with product_id and amount attributes.
+
+    Returns:
+    None
+    """
+    quantities = defaultdict(int)
+    for row in released:
+        quantities[row.product_id] += row.amount
+    if not quantities:
+        return
+    db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(quantities))
+        .values(amount=Product.amount + db.case(dict(quantities), value=Product.id))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_reservation(db, token):
+    """
+    Cancels an active reservation and returns its stock. Releasing the
+    same reservation twice, or one that was consumed, does nothing. Not
+    committed.
+
+    Parameters:
+    db: The database session object.
+    token: The reservation token.
+
+    Returns:
+    bool: True if stock was returned.
+    """
+    released = db.session.execute(
+        db.update(StockReservation)
+        .where(StockReservation.token == token, StockReservation.status == "active")
+        .values(status="released")
+        .returning(StockReservation.product_id, StockReservation.amount)
+        .execution_options(synchronize_session=False)
+    ).all()
+    restock(db, released)
+    return bool(released)
+
+
+def release_expired_reservations(db, now=None):
+    """
+    Returns the stock of every reservation whose checkout was abandoned. Not committed.
+
+    Parameters:
+    db: The database session object.
+    now: The current time (defaults to now).
+
+    Returns:
+    int: The number of reservation lines released.
+    """
+    now = now or datetime.now(timezone.utc)
+    released = db.session.execute(
+        db.update(StockReservation)
+        .where(StockReservation.status == "active", StockReservation.expires_at < now)
+        .values(status="released")
+        .returning(StockReservation.product_id, StockReservation.amount)
+        .execution_options(synchronize_session=False)
+    ).all()
+    restock(db, released)
+    return len(released)
+
+
+def consume_reservation(db, token):
+    """
+    Marks a reservation as paid. Its stock was already taken at checkout. Not committed.
+
+    Parameters:
+    db: The database session object.
+    token: The reservation token, or None for sessions created without one.
+
+    Returns:
+    bool: True if an active reservation was consumed; False means the stock
+    still has to be decremented (no reservation, or it expired first).
+    """
+    if not token:
+        return False
+    result = db.session.execute(
+        db.update(StockReservation)
+        .where(StockReservation.token == token, StockReservation.status == "active")
+        .values(status="consumed")
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount > 0
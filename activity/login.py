@@ -1,7 +1,8 @@
 from models import User
+from activity.basket import merge_guest_basket
 
 
-def login_in(request, login_user, check_password_hash, db):
+def login_in(request, login_user, check_password_hash, db, session):
     """
     Handles user login by verifying email and password credentials.
 
@@ -10,6 +11,7 @@ def login_in(request, login_user, check_password_hash, db):
     - login_user (function): A function that logs in a user in the current session.
     - check_password_hash (function): A function to validate the hashed password with the input password.
     - db (SQLAlchemy): The database instance for querying user data.
+    - session (flask.session): The session; a guest basket found in it is merged into the user's basket.
 
     Returns:
     - tuple: (int, str or None)
@@ -22,7 +24,7 @@ def login_in(request, login_user, check_password_hash, db):
     - "Wrong password" if the password is incorrect.
 
     Example:
-    >>> status, alert = login_in(request, login_user, check_password_hash, db)
+    >>> status, alert = login_in(request, login_user, check_password_hash, db, session)
     >>> if status == 0:
     >>>     print("Login successful")
     >>> else:
@@ -41,6 +43,8 @@ def login_in(request, login_user, check_password_hash, db):
 
     if check_password_hash(user.password, password):
         login_user(user)
+        # Keep what the user put in the basket before logging in
+        merge_guest_basket(db, session, user.id)
         return 0, None
     else:
         return 1, "Wrong password"
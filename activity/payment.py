@@ -1,51 +1,22 @@
-from models import BasketProduct
+import asyncio
+import hashlib
+import json
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
 
+from sqlalchemy.dialects.sqlite import insert
 
-def remove_unavailable_products(db, basket_products):
-    """
-    Filters out basket products that are no longer available (amount <= 0)
-    and removes them from the database.
-
-    Parameters:
-    db: The database session object for committing changes.
-    basket_products: A list of BasketProduct objects to filter.
-
-    Returns:
-    A filtered list of basket products with available stock.
-    """
-    filtered_basket_products = basket_products[:]
-    for basket_product in basket_products:
-        if basket_product.product.amount <= 0:
-            db.session.delete(basket_product)
-            filtered_basket_products.remove(basket_product)
-    db.session.commit()
-    return filtered_basket_products
+from models import CheckoutSession
+from payments import PaymentError, create_checkout_session_async, expire_checkout_session, expire_checkout_session_async
+from activity.basket import basket_owner, load_basket_products
+from activity.inventory import reserve_stock, release_reservation, release_expired_reservations
 
+# A cached checkout session is only handed out again if it stays open at least this long
+CHECKOUT_REUSE_MARGIN = timedelta(minutes=10)
 
-def get_basket_products(current_user, db, session):
-    """
-    Retrieves the basket products for the current user or session.
-
-    Parameters:
-    current_user: The currently logged-in user.
-    db: The database session object for querying.
-    session: The session object to store data for non-authenticated users.
-
-    Returns:
-    A list of BasketProduct objects or an empty list if no products are found.
-    """
-    if current_user.is_authenticated:
-        basket_products = db.session.execute(
-            db.select(BasketProduct).where(BasketProduct.user_id == current_user.id)
-        ).scalars().all()
-    else:
-        if "user_id" not in session:
-            return []
-        basket_products = db.session.execute(
-            db.select(BasketProduct).where(BasketProduct.cookie_id == session["user_id"])
-        ).scalars().all()
-
-    return basket_products or []
+# A reservation waiting for its Stripe checkout session; params are those of checkout.sessions.create
+PendingCheckout = namedtuple("PendingCheckout", ["owner", "fingerprint", "token", "expires_at", "params"])
 
 
 def convert_basket_products_to_json(basket_products):
@@ -74,72 +45,360 @@ def convert_basket_products_to_json(basket_products):
     return basket_items
 
 
-def generate_alerts_for_insufficient_stock(basket_products):
+def generate_alerts_for_insufficient_stock(basket_products, shortages):
     """
     Generates alerts for products that do not have sufficient stock to fulfill the order.
 
     Parameters:
-    basket_products: A list of BasketProduct objects to check.
+    basket_products: A list of BasketProduct objects in the checkout.
+    shortages: The IDs of the products that could not be reserved.
 
     Returns:
     A list of alert messages, if any products are understocked.
     """
     alerts = []
     for basket_product in basket_products:
-        if basket_product.product.amount < basket_product.amount:
+        if basket_product.product_id in shortages:
             alerts.append(f"Brak produktu: {basket_product.product.name} na stanie w ilości {basket_product.amount}!")
     return alerts
 
 
-def process_checkout_or_generate_alerts(current_user, db, session, stripe):
+def basket_fingerprint(owner, basket_products):
+    """
+    Hashes what a checkout session is created for.
+
+    Parameters:
+    owner: The owner key returned by basket_owner.
+    basket_products: The BasketProduct objects in the checkout, with their products.
+
+    Returns:
+    A sha256 hex digest of the owner and the (product, quantity, price) lines.
+    """
+    lines = sorted((bp.product_id, bp.amount, bp.product.price) for bp in basket_products)
+    return hashlib.sha256(json.dumps([list(owner), lines]).encode()).hexdigest()
+
+
+def owner_key(owner):
+    """
+    Returns the string stored in checkoutSessions.owner for a basket owner.
+
+    Parameters:
+    owner: The owner key returned by basket_owner.
+
+    Returns:
+    "user:<id>" or "cookie:<id>".
+    """
+    return f"{owner[0]}:{owner[1]}"
+
+
+def find_open_checkout_session(db, owner):
+    """
+    Fetches the checkout session last created for a basket, if any.
+
+    Parameters:
+    db: The database session object used for querying.
+    owner: The owner key returned by basket_owner.
+
+    Returns:
+    The CheckoutSession object or None.
+    """
+    return db.session.execute(
+        db.select(CheckoutSession).where(CheckoutSession.owner == owner_key(owner))
+    ).scalar()
+
+
+def is_reusable(checkout_session, fingerprint):
+    """
+    Tells whether a cached checkout session can be handed out again.
+
+    Parameters:
+    checkout_session: The cached CheckoutSession object.
+    fingerprint: The fingerprint of the basket as it is now.
+
+    Returns:
+    True if the basket is unchanged and the session stays open long enough to pay.
+    """
+    expires_at = checkout_session.expires_at.replace(tzinfo=timezone.utc)
+    return (checkout_session.fingerprint == fingerprint
+            and expires_at > datetime.now(timezone.utc) + CHECKOUT_REUSE_MARGIN)
+
+
+def forget_checkout_session(db, token):
     """
-    Handles checkout session creation or generates alerts for insufficient stock.
+    Stops handing out the checkout session of a reservation (paid, expired
+    or cancelled). Not committed.
+
+    Parameters:
+    db: The database session object.
+    token: The reservation token of the session.
+
+    Returns:
+    None
+    """
+    db.session.execute(
+        db.delete(CheckoutSession).where(CheckoutSession.reservation_token == token)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def find_shortages(basket_products):
+    """
+    Pre-flight stock check on the already loaded basket, before anything is reserved.
+
+    Parameters:
+    basket_products: The BasketProduct objects in the checkout, with their products.
+
+    Returns:
+    The IDs of the products with less available stock than the basket asks for.
+    """
+    return [bp.product_id for bp in basket_products if bp.product.amount < bp.amount]
+
+
+def prepare_checkout(current_user, db, session, ttl):
+    """
+    Reserves the basket's stock for a new Stripe checkout session, or answers
+    without Stripe: empty basket, stock alerts, or a reusable open session.
+
+    An unchanged basket gets its open checkout session back. Otherwise the
+    stock is checked against the loaded basket, then reserved; the
+    reservation is committed before returning, so no database lock is held
+    while Stripe is called. It is released if Stripe fails, on /denied, when
+    the session expires, or by release_expired_reservations.
 
     Parameters:
     current_user: The currently logged-in user.
     db: The database session object for querying and committing changes.
     session: The session object for non-authenticated users.
-    abort: Function to abort the request with a specific HTTP error.
-    stripe: The Stripe object for handling payment sessions.
+    ttl: How many seconds the checkout session (and the reservation) stays open.
 
     Returns:
+    - (-1, []): If the basket is empty.
     - (1, alerts): If there are stock alerts that need user attention.
-    - (0, checkout_session): If a successful Stripe checkout session was created.
+    - (0, checkout_session): The cached checkout session with its "url".
+    - (2, pending): A PendingCheckout to create the Stripe session for.
+    - (3, stripe_session_id): The basket changed while its last session is still
+      open; expire it at Stripe and discard_checkout_session it first.
     """
-    basket_products = get_basket_products(current_user, db, session)
+    owner = basket_owner(current_user, session)
+    basket_products = load_basket_products(db, owner)
 
     if not basket_products:
         return -1, [] # No basket products found, return -1
 
-    # Filter out unavailable products
-    basket_products = remove_unavailable_products(db, basket_products)
+    cached = find_open_checkout_session(db, owner)
+    if cached is not None:
+        if is_reusable(cached, basket_fingerprint(owner, basket_products)):
+            return 0, {"id": cached.stripe_session_id, "url": cached.url}
+        if cached.expires_at.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc):
+            # Its stock may only be given back once the old session can no longer be paid
+            return 3, cached.stripe_session_id
+        # Stripe already expired it: give back what it reserved and look at the stock again
+        release_reservation(db, cached.reservation_token)
+        db.session.delete(cached)
+        db.session.flush()
+        db.session.expire_all()
+        basket_products = load_basket_products(db, owner)
 
-    try:
-        # Convert basket products to Stripe's JSON format for checkout
-        converted_basket_products_to_json = convert_basket_products_to_json(basket_products)
+    # Pre-flight on the loaded rows: no reservation and no Stripe call for a basket that cannot be paid.
+    # Sold-out lines are reported, not deleted: stock held by other checkouts may still come back.
+    shortages = find_shortages(basket_products)
+    if shortages:
+        return 1, generate_alerts_for_insufficient_stock(basket_products, shortages)  # Return stock alerts
 
+    # Return the stock of abandoned checkouts before taking ours
+    release_expired_reservations(db)
+
+    # Take the stock out atomically, all or nothing
+    quantities = {basket_product.product_id: basket_product.amount for basket_product in basket_products}
+    token, shortages = reserve_stock(db, quantities, timedelta(seconds=ttl))
+    db.session.commit()
+
+    if shortages:
+        return 1, generate_alerts_for_insufficient_stock(basket_products, shortages)  # Lost a race for the stock
+
+    expires_at = int(time.time()) + ttl
+    params = {
         # Prepare metadata for Stripe
-        metadata = {str(basket_product.product_id): basket_product.amount for basket_product in basket_products}
-
-        # Create a Stripe checkout session
-        checkout_session = stripe.checkout.Session.create(
-            metadata=metadata,
-            shipping_address_collection={"allowed_countries": ["PL"]},
-            line_items=converted_basket_products_to_json,
-            mode='payment',
-            success_url='http://127.0.0.1:4242/success',
-            cancel_url='http://127.0.0.1:4242/denied',
-            automatic_tax={'enabled': True},
-            locale='pl'
-        )
-    except stripe.error.StripeError as e:
-        print("test")
-        return -2, str(e)  # Handle Stripe errors
+        "metadata": {str(product_id): amount for product_id, amount in quantities.items()},
+        "client_reference_id": token,
+        "expires_at": expires_at,
+        "shipping_address_collection": {"allowed_countries": ["PL"]},
+        # Convert basket products to Stripe's JSON format for checkout
+        "line_items": convert_basket_products_to_json(basket_products),
+        "mode": 'payment',
+        "success_url": 'http://127.0.0.1:4242/success',
+        "cancel_url": f'http://127.0.0.1:4242/denied?reservation={token}',
+        "automatic_tax": {'enabled': True},
+        "locale": 'pl'
+    }
+    return 2, PendingCheckout(owner_key(owner), basket_fingerprint(owner, basket_products), token, expires_at, params)
+
+
+def finish_checkout(db, pending, checkout_session):
+    """
+    Remembers the Stripe checkout session created for a pending checkout, so
+    the same session is handed out again while the basket stays the same.
+
+    Two concurrent checkouts of one basket both get this far; only the first
+    one is recorded, and the caller must expire and abandon the other.
+
+    Parameters:
+    db: The database session object for committing changes.
+    pending: The PendingCheckout returned by prepare_checkout.
+    checkout_session: The Stripe checkout session.
+
+    Returns:
+    bool: False if another checkout of the basket was recorded first.
+    """
+    recorded = db.session.execute(
+        insert(CheckoutSession).values(
+            owner=pending.owner,
+            fingerprint=pending.fingerprint,
+            stripe_session_id=checkout_session["id"],
+            url=checkout_session["url"],
+            reservation_token=pending.token,
+            expires_at=datetime.fromtimestamp(pending.expires_at, timezone.utc)
+        ).on_conflict_do_nothing(index_elements=[CheckoutSession.owner])
+    ).rowcount == 1
+    db.session.commit()
+    return recorded
+
+
+def find_recorded_checkout(db, owner):
+    """
+    Fetches the checkout session recorded for a basket.
 
-    # Generate alerts for any insufficient stock
-    alerts = generate_alerts_for_insufficient_stock(basket_products)
+    Parameters:
+    db: The database session object used for querying.
+    owner: The owner string, as in PendingCheckout.owner.
+
+    Returns:
+    A dict with the "id" and "url" of the session, or None.
+    """
+    cached = db.session.execute(
+        db.select(CheckoutSession.stripe_session_id, CheckoutSession.url).where(CheckoutSession.owner == owner)
+    ).first()
+    return {"id": cached.stripe_session_id, "url": cached.url} if cached else None
+
+
+def abandon_checkout(db, pending):
+    """
+    Gives back the stock of a pending checkout that has no payable Stripe session.
+
+    Parameters:
+    db: The database session object for committing changes.
+    pending: The PendingCheckout returned by prepare_checkout.
+
+    Returns:
+    None
+    """
+    # No session, so nobody will pay for the reserved stock
+    release_reservation(db, pending.token)
+    db.session.commit()
+
+
+def discard_checkout_session(db, stripe_session_id):
+    """
+    Gives back the stock of an expired checkout session and stops handing it out.
 
-    if alerts:
-        return 1, alerts  # Return stock alerts
-    else:
+    Parameters:
+    db: The database session object for committing changes.
+    stripe_session_id: The ID of the Stripe checkout session, already expired at Stripe.
+
+    Returns:
+    None
+    """
+    cached = db.session.execute(
+        db.select(CheckoutSession).where(CheckoutSession.stripe_session_id == stripe_session_id)
+    ).scalar()
+    if cached is not None:
+        release_reservation(db, cached.reservation_token)
+        db.session.delete(cached)
+    db.session.commit()
+
+
+def cancel_checkout(db, gateway, token):
+    """
+    Cancels the checkout of a reservation when the customer comes back from Stripe without paying.
+
+    The stock is only given back once the Stripe session is expired; if it
+    cannot be (Stripe is down, or it was paid after all), the reservation
+    stays until the expiry webhook or release_expired_reservations. Not
+    committed.
+
+    Parameters:
+    db: The database session object.
+    gateway: The PaymentGateway.
+    token: The reservation token from the cancel URL.
+
+    Returns:
+    bool: True if the stock was given back.
+    """
+    cached = db.session.execute(
+        db.select(CheckoutSession).where(CheckoutSession.reservation_token == token)
+    ).scalar()
+    if cached is not None:
+        try:
+            expire_checkout_session(gateway, cached.stripe_session_id)
+        except PaymentError:
+            return False
+        db.session.delete(cached)
+    # Without a cached row the session was already paid, expired or replaced (and expired)
+    return release_reservation(db, token)
+
+
+async def process_checkout_or_generate_alerts(current_user, db, session, gateway, ttl):
+    """
+    Reserves the basket's stock and creates a Stripe checkout session for it,
+    or generates alerts for insufficient stock.
+
+    The database work runs in worker threads and the Stripe calls on the
+    gateway's event loop, so the view holds no thread while Stripe answers.
+
+    Parameters:
+    current_user: The currently logged-in user.
+    db: The database session object for querying and committing changes.
+    session: The session object for non-authenticated users.
+    gateway: The PaymentGateway used to create the checkout session.
+    ttl: How many seconds the checkout session (and the reservation) stays open.
+
+    Returns:
+    - (-1, []): If the basket is empty.
+    - (-2, message): If Stripe rejected the checkout session.
+    - (1, alerts): If there are stock alerts that need user attention.
+    - (0, checkout_session): The Stripe checkout session (or the cached one) with its "url".
+    """
+    x, y = await asyncio.to_thread(prepare_checkout, current_user, db, session, ttl)
+    if x == 3:
+        # The basket changed: the old session must not stay payable once its stock is given back
+        try:
+            await expire_checkout_session_async(gateway, y)
+        except PaymentError as e:
+            return -2, str(e)
+        await asyncio.to_thread(discard_checkout_session, db, y)
+        x, y = await asyncio.to_thread(prepare_checkout, current_user, db, session, ttl)
+        if x == 3:
+            return -2, "The basket is being checked out in another window."
+    if x != 2:
+        return x, y
+
+    pending = y
+    try:
+        checkout_session = await create_checkout_session_async(gateway, pending.params)
+    except PaymentError as e:
+        await asyncio.to_thread(abandon_checkout, db, pending)
+        return -2, str(e)  # Handle Stripe errors
+
+    if await asyncio.to_thread(finish_checkout, db, pending, checkout_session):
         return 0, checkout_session  # Return a successful checkout session
+
+    # A concurrent checkout of the same basket won: hand out its session and drop ours
+    try:
+        await expire_checkout_session_async(gateway, checkout_session["id"])
+        await asyncio.to_thread(abandon_checkout, db, pending)
+    except PaymentError:
+        pass  # Ours stays reserved until it expires at Stripe
+    winner = await asyncio.to_thread(find_recorded_checkout, db, pending.owner)
+    if winner is None:
+        return -2, "The basket is being checked out in another window."
+    return 0, winner
@@ -1,138 +1,117 @@
-from models import Category, Product
-
-
-def get_products(db, request):
+from collections import namedtuple
+
+from models import Product
+from activity.categories import get_categories
+from activity.catalog import select_catalog_products, paginate_keyset, read_page_request
+from activity.search import apply_search, search_rank
+
+# sort name -> (column, descending); Product.id breaks ties in the same direction
+SORT_OPTIONS = {
+    "newest": (Product.id, True),
+    "price_asc": (Product.price, False),
+    "price_desc": (Product.price, True),
+    "name": (Product.name, False),
+}
+DEFAULT_SORT = "newest"
+# Only meaningful with a search; it is the default sort when ?q= is given
+RELEVANCE_SORT = "relevance"
+MAX_SEARCH_LENGTH = 200
+
+# Legacy ?price=1..4 buckets, kept so old links keep working: (min_price, max_price)
+PRICE_RANGES = {
+    "1": (None, 499),
+    "2": (500, 1000),
+    "3": (1001, 5000),
+    "4": (5001, None),
+}
+
+CatalogFilters = namedtuple("CatalogFilters", ["min_price", "max_price", "category_ids", "sort", "q"])
+
+
+def read_catalog_filters(request):
     """
-    Retrieves products based on optional filters for category and price.
+    Reads the catalog filters from the query string.
+
+    Supported arguments: q (search text), min_price, max_price, category (repeatable),
+    sort, and the legacy price bucket (1-4) which is translated into a price range.
 
     Parameters:
-    db: The database session object.
     request: The request object containing query parameters.
 
     Returns:
-    A tuple containing:
-        - products: The filtered list of products.
-        - value: The filter value corresponding to the selected price range.
-        - category_id: The ID of the selected category.
-        - categories: The list of all categories available.
+    A CatalogFilters tuple. Invalid values are ignored.
     """
-    # Retrieve all categories from the database
-    categories = db.session.execute(db.select(Category)).scalars().all()
-
-    # Get filter criteria from request arguments
-    category_id = request.args.get("category")
-    price = request.args.get("price")
-
-    # Determine which filter(s) to apply
-    if price and category_id:
-        products, value = get_products_for_filter_price_and_category(db, price, category_id)
-    elif category_id:
-        products, value = get_products_for_filter_category(db, category_id)
-    elif price:
-        products, value = get_products_for_filter_price(db, price)
-    else:
-        # If no filters are applied, retrieve all products
-        products = db.session.execute(db.select(Product)).scalars().all()
-        value = None
-
-    return products, value, category_id, categories
+    min_price = request.args.get("min_price", type=int)
+    max_price = request.args.get("max_price", type=int)
+    if min_price is None and max_price is None:
+        min_price, max_price = PRICE_RANGES.get(request.args.get("price"), (None, None))
 
+    category_ids = sorted({category_id for category_id in request.args.getlist("category", type=int)})
 
-def get_products_for_filter_price_and_category(db, price, category_id):
-    """
-    Retrieves products filtered by both price range and category.
-
-    Parameters:
-    db: The database session object.
-    price: The price range identifier.
-    category_id: The ID of the category to filter by.
+    q = request.args.get("q", "").strip()[:MAX_SEARCH_LENGTH]
 
-    Returns:
-    A tuple containing:
-        - products: The list of filtered products.
-        - value: The filter value corresponding to the selected price range.
-    """
-    if price == "1":
-        value = 1
-        products = db.session.execute(
-            db.select(Product).where(Product.category_id == category_id, Product.price < 500)
-        ).scalars().all()
-    elif price == "2":
-        value = 2
-        products = db.session.execute(
-            db.select(Product).where(Product.category_id == category_id, Product.price >= 500, Product.price <= 1000)
-        ).scalars().all()
-    elif price == "3":
-        value = 3
-        products = db.session.execute(
-            db.select(Product).where(Product.category_id == category_id, Product.price > 1000, Product.price <= 5000)
-        ).scalars().all()
-    elif price == "4":
-        value = 4
-        products = db.session.execute(
-            db.select(Product).where(Product.category_id == category_id, Product.price > 5000)
-        ).scalars().all()
-    else:
-        products = None
-        value = None
+    sort = request.args.get("sort")
+    if sort == RELEVANCE_SORT and not q:
+        sort = None
+    if sort not in SORT_OPTIONS and sort != RELEVANCE_SORT:
+        sort = RELEVANCE_SORT if q else DEFAULT_SORT
 
-    return products, value
+    return CatalogFilters(min_price, max_price, category_ids, sort, q)
 
 
-def get_products_for_filter_category(db, category_id):
+def build_catalog_query(db, filters):
     """
-    Retrieves products filtered by category.
+    Builds the product query for any combination of filters.
+
+    Every combination maps onto a single range scan of ix_products_price or
+    ix_products_category_id_price, or onto the products_fts index when
+    there is a search.
 
     Parameters:
     db: The database session object.
-    category_id: The ID of the category to filter by.
+    filters: The CatalogFilters to apply.
 
     Returns:
-    A tuple containing:
-        - products: The list of products in the specified category.
-        - value: None (no price filter applied).
+    A tuple (query, ranked): the SELECT statement without ORDER BY (pagination
+    adds it), and whether it can be ordered by search relevance.
     """
-    value = None
-    return db.session.execute(
-        db.select(Product).where(Product.category_id == category_id)
-    ).scalars().all(), value
+    query, ranked = apply_search(db, select_catalog_products(db), filters.q)
+    if filters.category_ids:
+        query = query.where(Product.category_id.in_(filters.category_ids))
+    if filters.min_price is not None:
+        query = query.where(Product.price >= filters.min_price)
+    if filters.max_price is not None:
+        query = query.where(Product.price <= filters.max_price)
+    return query, ranked
 
 
-def get_products_for_filter_price(db, price):
+def get_products(db, request, per_page):
     """
-    Retrieves products filtered by price range.
+    Retrieves one page of products matching the filters in the query string.
 
     Parameters:
     db: The database session object.
-    price: The price range identifier.
+    request: The request object containing query parameters.
+    per_page: The default page size.
 
     Returns:
     A tuple containing:
-        - products: The list of products in the specified price range.
-        - value: The filter value corresponding to the selected price range.
+        - page: The Page of filtered products, with next/prev cursors.
+        - filters: The CatalogFilters that were applied.
+        - categories: The list of all categories available.
     """
-    if price == "1":
-        value = 1
-        products = db.session.execute(
-            db.select(Product).where(Product.price < 500)
-        ).scalars().all()
-    elif price == "2":
-        value = 2
-        products = db.session.execute(
-            db.select(Product).where(Product.price >= 500, Product.price <= 1000)
-        ).scalars().all()
-    elif price == "3":
-        value = 3
-        products = db.session.execute(
-            db.select(Product).where(Product.price > 1000, Product.price <= 5000)
-        ).scalars().all()
-    elif price == "4":
-        value = 4
-        products = db.session.execute(
-            db.select(Product).where(Product.price > 5000)
-        ).scalars().all()
+    # Categories come from the in-process cache
+    categories = get_categories(db)
+
+    filters = read_catalog_filters(request)
+    query, ranked = build_catalog_query(db, filters)
+
+    # Only fetch the requested page, in the requested order
+    if filters.sort == RELEVANCE_SORT:
+        # bm25 rank: lower is more relevant
+        sort_column, descending = (search_rank(), False) if ranked else SORT_OPTIONS[DEFAULT_SORT]
     else:
-        products = None
-        value = None
+        sort_column, descending = SORT_OPTIONS[filters.sort]
+    page = paginate_keyset(db, query, sort_column, descending=descending, **read_page_request(request, per_page))
 
-    return products, value
+    return page, filters, categories
@@ -1,4 +1,5 @@
 from models import User
+from activity.basket import merge_guest_basket
 import re  # For email validation
 
 def is_valid_email(email):
@@ -61,7 +62,7 @@ def create_new_user(db, username, email, password, generate_password_hash):
     Creates a new user and saves it to the database.
 
     Parameters:
-    - db (SQLAlchemy): The database session object for committing changes.
+    - db (SQLAlchemy): The database session object.
     - username (str): The username for the new user.
     - email (str): The email for the new user.
     - password (str): The plaintext password for the new user.
@@ -77,19 +78,20 @@ def create_new_user(db, username, email, password, generate_password_hash):
                     permission=0)
 
     db.session.add(new_user)
-    db.session.commit()
+    db.session.flush()  # Assigns the ID; the request commits
     return new_user
 
-def register_user(request, db, alerts, login_user, generate_password_hash):
+def register_user(request, db, alerts, login_user, generate_password_hash, session):
     """
     Manages user registration, including validation and database insertion.
 
     Parameters:
     - request (flask.Request): The HTTP request object containing form data.
-    - db (SQLAlchemy): The database session object for querying and committing changes.
+    - db (SQLAlchemy): The database session object for querying and writing changes.
     - alerts (list): A list to hold alert messages for validation issues.
     - login_user (function): A function that logs in the newly registered user.
     - generate_password_hash (function): A function to hash the user password.
+    - session (flask.session): The session; a guest basket found in it becomes the new user's basket.
 
     Returns:
     - tuple: (int, list)
@@ -115,5 +117,7 @@ def register_user(request, db, alerts, login_user, generate_password_hash):
         # Create and log in the new user
         new_user = create_new_user(db, username, email, password, generate_password_hash)
         login_user(new_user)
+        # Keep what the guest put in the basket before registering
+        merge_guest_basket(db, session, new_user.id)
         return 0, []
     return 1, alerts
@@ -0,0 +1,189 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy.dialects.sqlite import insert
+
+from models import Category, Order, OrderItem, Product, SalesDay, SalesDayCategory, SalesDayProduct
+
+# Category key of products without a category
+UNCATEGORIZED = 0
+DEFAULT_REPORT_DAYS = 30
+TOP_PRODUCTS = 20
+
+
+def upsert_sales(db, model, key_columns, rows):
+    """
+    Adds sales to rollup rows, creating the rows that do not exist yet.
+
+    Parameters:
+    db: The database session object.
+    model: The rollup model (SalesDay, SalesDayProduct or SalesDayCategory).
+    key_columns: The names of the model's primary key columns.
+    rows: Dicts with the key columns plus revenue, units and orders to add.
+
+    Returns:
+    None
+    """
+    if not rows:
+        return
+    statement = insert(model)
+    set_ = {name: getattr(model, name) + getattr(statement.excluded, name) for name in ("revenue", "units", "orders")}
+    if "name" in rows[0]:
+        set_["name"] = statement.excluded.name
+    db.session.execute(statement.on_conflict_do_update(index_elements=key_columns, set_=set_), rows)
+
+
+def record_order_sales(db, day, products, quantities):
+    """
+    Adds one paid order to the daily rollups. Not committed; the webhook
+    commits it together with the order.
+
+    Parameters:
+    db: The database session object.
+    day: The UTC date of the order.
+    products: The {product_id: (id, name, price, category_id)} mapping returned by fetch_order_products.
+    quantities: The {product_id: quantity} mapping of the order.
+
+    Returns:
+    None
+    """
+    product_rows = []
+    categories = defaultdict(lambda: {"revenue": 0, "units": 0})
+    for product_id, quantity in quantities.items():
+        product = products[product_id]
+        revenue = product.price * quantity
+        product_rows.append({"day": day, "product_id": product_id, "name": product.name,
+                             "revenue": revenue, "units": quantity, "orders": 1})
+        category = categories[product.category_id or UNCATEGORIZED]
+        category["revenue"] += revenue
+        category["units"] += quantity
+
+    upsert_sales(db, SalesDay, ["day"], [{
+        "day": day,
+        "revenue": sum(row["revenue"] for row in product_rows),
+        "units": sum(row["units"] for row in product_rows),
+        "orders": 1,
+    }])
+    upsert_sales(db, SalesDayProduct, ["day", "product_id"], product_rows)
+    upsert_sales(db, SalesDayCategory, ["day", "category_id"], [
+        {"day": day, "category_id": category_id, "orders": 1, **totals}
+        for category_id, totals in categories.items()
+    ])
+
+
+def rebuild_sales_rollups(db):
+    """
+    Recomputes every rollup from orders and orderItems, in three INSERT ... SELECT statements.
+
+    Orders without created_at (placed before it was recorded) are left out.
+    Categories are those the products have now. Not committed.
+
+    Parameters:
+    db: The database session object.
+
+    Returns:
+    int: The number of orders counted.
+    """
+    for model in (SalesDay, SalesDayProduct, SalesDayCategory):
+        db.session.execute(db.delete(model))
+
+    day = db.func.date(Order.created_at)
+    revenue = db.func.sum(db.func.coalesce(OrderItem.unit_price, 0) * OrderItem.quantity)
+    units = db.func.sum(OrderItem.quantity)
+    orders = db.func.count(db.distinct(Order.id))
+    category_id = db.func.coalesce(Product.category_id, UNCATEGORIZED)
+    paid_items = db.select().select_from(Order).join(OrderItem).where(Order.created_at.is_not(None))
+
+    db.session.execute(db.insert(SalesDay).from_select(
+        ["day", "revenue", "units", "orders"],
+        paid_items.add_columns(day, revenue, units, orders).group_by(day)
+    ))
+    db.session.execute(db.insert(SalesDayProduct).from_select(
+        ["day", "product_id", "name", "revenue", "units", "orders"],
+        paid_items.add_columns(day, OrderItem.product_id, db.func.max(OrderItem.name), revenue, units, orders)
+        .group_by(day, OrderItem.product_id)
+    ))
+    db.session.execute(db.insert(SalesDayCategory).from_select(
+        ["day", "category_id", "revenue", "units", "orders"],
+        paid_items.outerjoin(Product, Product.id == OrderItem.product_id)
+        .add_columns(day, category_id, revenue, units, orders).group_by(day, category_id)
+    ))
+    return db.session.execute(db.select(db.func.coalesce(db.func.sum(SalesDay.orders), 0))).scalar_one()
+
+
+def sums(db, model):
+    """Returns the summed revenue, units and orders columns of a rollup."""
+    return (db.func.sum(model.revenue).label("revenue"),
+            db.func.sum(model.units).label("units"),
+            db.func.sum(model.orders).label("orders"))
+
+
+def figures(row):
+    """Returns the revenue, units and orders of a row as a dict; sums over no rows are 0."""
+    return {"revenue": row.revenue or 0, "units": row.units or 0, "orders": row.orders or 0}
+
+
+def read_report_range(request):
+    """
+    Reads the date range of a report from the query string (start, end as YYYY-MM-DD).
+
+    Parameters:
+    request: The request object containing query parameters.
+
+    Returns:
+    A tuple (start, end) of dates, both inclusive. Defaults to the last DEFAULT_REPORT_DAYS days.
+    """
+    end = request.args.get("end", type=date.fromisoformat) or datetime.now(timezone.utc).date()
+    start = request.args.get("start", type=date.fromisoformat) or end - timedelta(days=DEFAULT_REPORT_DAYS - 1)
+    return (start, end) if start <= end else (end, start)
+
+
+def get_sales_report(db, start, end, top=TOP_PRODUCTS):
+    """
+    Answers a sales report for a date range from the rollups alone.
+
+    Every query is a range scan of a rollup's (day, ...) primary key, so
+    the cost depends on the number of days, not on the number of orders.
+
+    Parameters:
+    db: The database session object.
+    start: The first day of the range.
+    end: The last day of the range (inclusive).
+    top: How many products to list, by revenue.
+
+    Returns:
+    A JSON-serializable dict with the range, totals, days, products and categories.
+    """
+    days = db.session.execute(
+        db.select(SalesDay).where(SalesDay.day.between(start, end)).order_by(SalesDay.day)
+    ).scalars().all()
+    totals = db.session.execute(db.select(*sums(db, SalesDay)).where(SalesDay.day.between(start, end))).one()
+
+    products = db.session.execute(
+        db.select(SalesDayProduct.product_id, db.func.max(SalesDayProduct.name).label("name"), *sums(db, SalesDayProduct))
+        .where(SalesDayProduct.day.between(start, end))
+        .group_by(SalesDayProduct.product_id)
+        .order_by(db.func.sum(SalesDayProduct.revenue).desc(), SalesDayProduct.product_id)
+        .limit(top)
+    ).all()
+
+    categories = db.session.execute(
+        db.select(SalesDayCategory.category_id, Category.name, *sums(db, SalesDayCategory))
+        .outerjoin(Category, Category.id == SalesDayCategory.category_id)
+        .where(SalesDayCategory.day.between(start, end))
+        .group_by(SalesDayCategory.category_id, Category.name)
+        .order_by(db.func.sum(SalesDayCategory.revenue).desc())
+    ).all()
+
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        # An order with products from two categories counts once in each category, but once in totals
+        "totals": figures(totals),
+        "days": [{"day": row.day.isoformat(), **figures(row)} for row in days],
+        "products": [{"product_id": row.product_id, "name": row.name, **figures(row)} for row in products],
+        "categories": [
+            {"category_id": row.category_id, "name": row.name or "Uncategorized", **figures(row)}
+            for row in categories
+        ],
+    }
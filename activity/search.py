@@ -0,0 +1,166 @@
+import html
+import re
+
+import bleach
+from sqlalchemy import column, table, text
+
+from models import Product
+
+# products_fts is an FTS5 table whose rowid is the product id. It is kept in
+# sync by the activity functions that add, edit and delete products.
+FTS_TABLE = "products_fts"
+# Lightweight handle for queries; the hidden column named after the table is the MATCH target
+products_fts = table(FTS_TABLE, column("rowid"), column("rank"), column(FTS_TABLE))
+MAX_SEARCH_TERMS = 10
+
+
+def search_supported(db):
+    """
+    Tells whether the database has the FTS5 index (SQLite only).
+
+    Parameters:
+    db: The database object.
+
+    Returns:
+    True if searches can use products_fts.
+    """
+    return db.engine.dialect.name == "sqlite"
+
+
+def plain_text(description):
+    """
+    Strips the CKEditor HTML from a description before it is indexed.
+
+    Parameters:
+    description: The HTML description of a product.
+
+    Returns:
+    The description as plain text.
+    """
+    return html.unescape(bleach.clean(description, tags=[], strip=True))
+
+
+def index_product(db, product):
+    """
+    Adds or refreshes a product in the full-text index.
+
+    Parameters:
+    db: The database session object. The product must already have an id (flush first).
+    product: The Product object to index.
+
+    Returns:
+    None
+    """
+    if not search_supported(db):
+        return
+    unindex_product(db, product.id)
+    db.session.execute(
+        text(f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (:id, :name, :description)"),
+        {"id": product.id, "name": product.name, "description": plain_text(product.description)}
+    )
+
+
+def unindex_product(db, product_id):
+    """
+    Removes a product from the full-text index.
+
+    Parameters:
+    db: The database session object.
+    product_id: The ID of the product to remove.
+
+    Returns:
+    None
+    """
+    if not search_supported(db):
+        return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {"id": product_id})
+
+
+def rebuild_search_index(db, batch_size=500):
+    """
+    Creates the full-text index if needed and fills it from the products table.
+
+    Parameters:
+    db: The database session object.
+    batch_size: How many products are read per query.
+
+    Returns:
+    The number of products indexed.
+    """
+    if not search_supported(db):
+        return 0
+    db.session.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+        f"USING fts5(name, description, tokenize='unicode61 remove_diacritics 2')"
+    ))
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+
+    indexed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(Product.id, Product.name, Product.description)
+            .where(Product.id > last_id).order_by(Product.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(
+            text(f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (:id, :name, :description)"),
+            [{"id": row.id, "name": row.name, "description": plain_text(row.description)} for row in rows]
+        )
+        indexed += len(rows)
+        last_id = rows[-1].id
+    return indexed
+
+
+def build_match_expression(search):
+    """
+    Turns free text typed by a user into a safe FTS5 MATCH expression.
+
+    Every word becomes a quoted prefix term, and all of them must match.
+
+    Parameters:
+    search: The text from the search box.
+
+    Returns:
+    The MATCH expression, or None if the text contains no words.
+    """
+    terms = re.findall(r"\w+", search)[:MAX_SEARCH_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search_rank():
+    """
+    Returns the relevance of a search hit as an SQL expression (lower is better).
+
+    Returns:
+    The bm25 rank column of products_fts.
+    """
+    return products_fts.c.rank
+
+
+def apply_search(db, query, search):
+    """
+    Restricts a product query to the products matching a search.
+
+    Parameters:
+    db: The database object.
+    query: The SELECT statement for Product rows.
+    search: The text from the search box.
+
+    Returns:
+    A tuple (query, ranked): ranked is True when search_rank() can be used to order the query.
+    """
+    expression = build_match_expression(search)
+    if expression is None:
+        return query, False
+    if not search_supported(db):
+        pattern = f"%{search}%"
+        return query.where(Product.name.ilike(pattern) | Product.description.ilike(pattern)), False
+    query = (
+        query.join(products_fts, products_fts.c.rowid == Product.id)
+        .where(products_fts.c[FTS_TABLE].match(expression))
+    )
+    return query, True
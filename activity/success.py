@@ -1,20 +1,20 @@
-from models import BasketProduct
+from activity.basket import basket_owner, load_basket_products
 
 def delete_all_basket_products(db, session, current_user):
     """
     Deletes all products from the user's shopping basket.
 
     Parameters:
-    db: The database session object used for querying and committing changes.
+    db: The database session object used for querying and writing changes.
     session: The session object that contains user-related information.
     current_user: The currently authenticated user.
 
     Returns:
-    int: Returns 1 if no user ID is found in the session; otherwise, returns None.
+    int: Returns 1 if there is no basket (a guest who never added a product); otherwise, returns None.
     """
-    # Check if there is a user ID in the session
-    if "user_id" not in session:
-        return 1  # Return 1 if no user ID is found
+    # Check if there is a basket at all
+    if basket_owner(current_user, session) is None:
+        return 1  # Return 1 if there is no basket
 
     # Retrieve the basket products for the user
     basket_products = get_basket_products(db, session, current_user)
@@ -36,16 +36,7 @@ def get_basket_products(db, session, current_user):
     Returns:
     list: A list of BasketProduct objects belonging to the user.
     """
-    if not current_user.is_authenticated:
-        # Fetch basket products using the cookie ID for unauthenticated users
-        return db.session.execute(
-            db.select(BasketProduct).where(BasketProduct.cookie_id == session["user_id"])
-        ).scalars().all()
-    else:
-        # Fetch basket products using the user ID for authenticated users
-        return db.session.execute(
-            db.select(BasketProduct).where(BasketProduct.user_id == current_user.id)
-        ).scalars().all()
+    return load_basket_products(db, basket_owner(current_user, session))
 
 
 def delete_basket_products(db, basket_products):
@@ -53,7 +44,7 @@ def delete_basket_products(db, basket_products):
     Deletes the specified basket products from the database.
 
     Parameters:
-    db: The database session object used for committing changes.
+    db: The database session object used for writing changes.
     basket_products: A list of BasketProduct objects to delete.
 
     Returns:
@@ -63,5 +54,5 @@ def delete_basket_products(db, basket_products):
     for basket_product in basket_products:
         db.session.delete(basket_product)
 
-    # Commit the changes to the database
-    db.session.commit()
+    # Write the changes; they are committed with the request
+    db.session.flush()
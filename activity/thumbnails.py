@@ -0,0 +1,128 @@
+from io import BytesIO
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from models import Product, ProductImageVariant
+from storage import read_blob, store_blob
+
+# Variant name -> target width in pixels. "basket" is the basket line
+# thumbnail, "card" the /products grid and "detail" the /oneProduct page.
+IMAGE_VARIANTS = {
+    "basket": 160,
+    "card": 500,
+    "detail": 1000,
+}
+VARIANT_FORMAT = "WEBP"
+VARIANT_MIMETYPE = "image/webp"
+VARIANT_QUALITY = 80
+
+
+def product_srcset(url_for, product):
+    """
+    Builds the srcset attribute value listing every size variant of a product image.
+
+    Parameters:
+    url_for: Flask's url_for function.
+    product: The Product object.
+
+    Returns:
+    A string such as "/images/1/basket?v=... 160w, /images/1/card?v=... 500w, ...".
+    """
+    return ", ".join(
+        f"{url_for('product_image', product_id=product.id, size=size, v=product.image_hash)} {width}w"
+        for size, width in IMAGE_VARIANTS.items()
+    )
+
+
+def resize_image(original, width):
+    """
+    Scales an image down to the given width and re-encodes it.
+
+    Parameters:
+    original: A decoded PIL image.
+    width: The target width in pixels. Images are never upscaled.
+
+    Returns:
+    A tuple (image_bytes, actual_width).
+    """
+    image = original.copy()
+    if image.width > width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    output = BytesIO()
+    image.save(output, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+    return output.getvalue(), image.width
+
+
+def generate_image_variants(data):
+    """
+    Generates every configured size variant from the uploaded image bytes.
+
+    Parameters:
+    data: The raw bytes of the uploaded image.
+
+    Returns:
+    A list of (size, width, image_bytes, mimetype) tuples, or an empty list
+    when the upload cannot be decoded (the original is then served as is).
+    """
+    try:
+        original = Image.open(BytesIO(data))
+        # Let the JPEG decoder skip detail we are going to throw away anyway
+        original.draft("RGB", (max(IMAGE_VARIANTS.values()),) * 2)
+        original = ImageOps.exif_transpose(original)
+    except (UnidentifiedImageError, OSError):
+        return []
+
+    variants = []
+    for size, width in IMAGE_VARIANTS.items():
+        image_bytes, actual_width = resize_image(original, width)
+        variants.append((size, actual_width, image_bytes, VARIANT_MIMETYPE))
+    return variants
+
+
+def store_image_variants(product, data):
+    """
+    Replaces the size variants of a product with ones generated from new image bytes.
+
+    Parameters:
+    product: The Product object the image belongs to.
+    data: The raw bytes of the product's original image.
+
+    Returns:
+    None
+    """
+    # Update existing rows in place: the unit of work would otherwise insert
+    # the new (product_id, size) rows before deleting the old ones
+    existing = {variant.size: variant for variant in product.image_variants}
+    variants = []
+    for size, width, image_bytes, mimetype in generate_image_variants(data):
+        variant = existing.get(size) or ProductImageVariant(size=size)
+        variant.width = width
+        variant.image_hash = store_blob(image_bytes)
+        variant.image_mimetype = mimetype
+        variants.append(variant)
+    product.image_variants = variants
+
+
+def generate_missing_variants(db):
+    """
+    Backfills size variants for products uploaded before thumbnails existed.
+
+    Parameters:
+    db: The database session object for querying and committing changes.
+
+    Returns:
+    The number of products that received variants.
+    """
+    product_ids = db.session.execute(
+        db.select(ProductImageVariant.product_id).distinct()
+    ).scalars().all()
+    products = db.session.execute(
+        db.select(Product).where(Product.id.not_in(product_ids))
+    ).scalars().all()
+    for product in products:
+        store_image_variants(product, read_blob(product.image_hash))
+        db.session.commit()
+    return len(products)
@@ -1,23 +1,59 @@
-from models import Product, Order, BasketProduct
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.dialects.sqlite import insert
+
+from models import Product, Order, OrderItem, BasketProduct, WebhookEvent
+from activity.basket import basket_product_owner, invalidate_basket_count
+from activity.inventory import consume_reservation, release_reservation
+from activity.payment import forget_checkout_session
+from activity.reports import record_order_sales
+from payments import SignatureVerificationError, construct_webhook_event
+
+# An event claimed longer ago than this is assumed lost with its worker and may be claimed again
+WEBHOOK_CLAIM_TIMEOUT = timedelta(minutes=5)
+REPLAYABLE_STATUSES = ("pending", "failed")
+# Paid orders the stock could not cover; they are listed on /orders for a person to sort out
+SHORTAGE_STATUS = "stock_shortage"
+# One item of the legacy Order.body written by generate_order_body
+ORDER_BODY_ITEM = re.compile(r"id=(\d+) name=(.*?) amount=(\d+)   //   ")
 
 
 def create_order(event, db):
     """
-    Creates an order in the database based on the event data from Stripe.
+    Creates an order in the database based on the event data from Stripe,
+    or releases the stock reservation of an expired checkout session.
+    Nothing is committed; the caller commits the order together with the
+    inbox status of the event.
 
     Parameters:
     event: The Stripe webhook event containing order details.
-    db: The database session object used for querying and committing.
+    db: The database session object used for querying.
 
     Returns:
-    None
+    set: The owner keys of the baskets that lost a line.
     """
+    owners = set()
     if event['type'] == 'checkout.session.completed':
         order_details = extract_order_details(event)
         product_metadata = event['data']['object']['metadata']
 
-        body = generate_order_body(product_metadata, db)
+        # Stock, basket lines and the order are written in one transaction
+        quantities = read_order_quantities(product_metadata)
+        products = fetch_order_products(db, quantities)
+        body = generate_order_body(products, quantities)
+        # Stock reserved at checkout is already taken; only unreserved orders decrement it here
+        token = event['data']['object'].get('client_reference_id')
+        shortages = set()
+        if not consume_reservation(db, token):
+            shortages = update_product_amounts(db, quantities)
+        if token:
+            forget_checkout_session(db, token)  # A paid session must never be handed out again
+        owners = delete_products_from_basket(db, quantities)
         amount_total = int(event['data']['object']['amount_total']) * 0.01
+        # The event's creation time, so a replayed event lands on the day it was paid
+        created_at = datetime.fromtimestamp(event.get('created') or datetime.now(timezone.utc).timestamp(), timezone.utc)
 
         new_order = Order(
             city=order_details['city'],
@@ -27,13 +63,23 @@ def create_order(event, db):
             postal_code=order_details['postal_code'],
             amount_total=amount_total,
             body=body,
-            status="to_implement"
+            status=SHORTAGE_STATUS if shortages else "to_implement",
+            created_at=created_at
         )
 
         db.session.add(new_order)
-        db.session.commit()
+        db.session.flush()  # Assigns new_order.id
+        insert_order_items(db, new_order.id, products, quantities)
+        record_order_sales(db, created_at.date(), products, quantities)
+    elif event['type'] == 'checkout.session.expired':
+        # The customer never paid: give the reserved stock back
+        token = event['data']['object'].get('client_reference_id')
+        if token:
+            release_reservation(db, token)
+            forget_checkout_session(db, token)
     else:
         print(f'Unhandled event type {event["type"]}')
+    return owners
 
 
 def extract_order_details(event):
@@ -60,65 +106,311 @@ def extract_order_details(event):
     }
 
 
-def generate_order_body(product_metadata, db):
+def read_order_quantities(product_metadata):
     """
-    Generates the order body text and updates the product quantities.
+    Converts the checkout session metadata into ordered quantities.
 
     Parameters:
     product_metadata: The metadata containing product IDs and quantities.
+
+    Returns:
+    dict: {product_id: quantity}, in the order the products were bought.
+    """
+    return {int(product_id): int(quantity) for product_id, quantity in product_metadata.items()}
+
+
+def fetch_order_products(db, quantities):
+    """
+    Loads every product of an order in a single query.
+
+    Parameters:
     db: The database session object used for querying.
+    quantities: The {product_id: quantity} mapping of the order.
+
+    Returns:
+    dict: {product_id: (id, name, price, category_id)} for the ordered products.
+
+    Raises:
+    LookupError: If one of the products does not exist.
+    """
+    rows = db.session.execute(
+        db.select(Product.id, Product.name, Product.price, Product.category_id).where(Product.id.in_(quantities))
+    ).all()
+    products = {row.id: row for row in rows}
+    missing = set(quantities) - set(products)
+    if missing:
+        raise LookupError(f"Unknown product(s) in order: {sorted(missing)}")
+    return products
+
+
+def generate_order_body(products, quantities):
+    """
+    Generates the order body text.
+
+    Parameters:
+    products: The {product_id: (id, name, price, category_id)} mapping returned by fetch_order_products.
+    quantities: The {product_id: quantity} mapping of the order.
 
     Returns:
     str: A formatted string representing the order body.
     """
     body = ""
 
-    for product_id in product_metadata:
-        product = db.get_or_404(Product, product_id)
-        quantity = int(product_metadata[product_id])
-
+    for product_id, quantity in quantities.items():
+        product = products[product_id]
         body += f"id={product.id} name={product.name} amount={quantity}   //   "
-        product.amount -= quantity  # Update product amount
-        delete_products_from_basket(product, quantity, db)
 
     return body
 
-def invoke_webhook(request, stripe, endpoint_secret, db):
+
+def parse_order_body(body):
     """
-    Handles incoming webhook requests from Stripe and verifies the signature.
+    Reads the items back out of a legacy order body.
 
     Parameters:
-    request: The incoming request containing the webhook data.
-    stripe: The Stripe library instance.
-    endpoint_secret: The secret for verifying webhook signatures.
-    db: The database session object used for querying and committing.
+    body: The text written by generate_order_body.
+
+    Returns:
+    list: (product_id, name, quantity) tuples, in order.
+    """
+    return [(int(product_id), name, int(quantity)) for product_id, name, quantity in ORDER_BODY_ITEM.findall(body)]
+
+
+def insert_order_items(db, order_id, products, quantities):
+    """
+    Writes the line items of an order in a single bulk INSERT.
+
+    Parameters:
+    db: The database session object.
+    order_id: The ID of the order.
+    products: The {product_id: (id, name, price, category_id)} mapping returned by fetch_order_products.
+    quantities: The {product_id: quantity} mapping of the order.
 
     Returns:
     None
     """
+    db.session.execute(db.insert(OrderItem), [
+        {
+            "order_id": order_id,
+            "product_id": product_id,
+            "name": products[product_id].name,
+            "unit_price": products[product_id].price,
+            "quantity": quantity,
+        }
+        for product_id, quantity in quantities.items()
+    ])
+
+
+def update_product_amounts(db, quantities):
+    """
+    Subtracts the ordered quantities from stock in a single UPDATE.
+
+    Only products with enough stock are decremented; stock never goes
+    negative, even for a session paid after its reservation was given back.
+
+    Parameters:
+    db: The database session object.
+    quantities: The {product_id: quantity} mapping of the order.
+
+    Returns:
+    set: The IDs of the products whose stock could not cover the order.
+    """
+    ordered = db.case(quantities, value=Product.id)
+    updated = db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(quantities), Product.amount >= ordered)
+        .values(amount=Product.amount - ordered)
+        .returning(Product.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    return set(quantities) - set(updated)
+
+def invoke_webhook(request, gateway, db):
+    """
+    Handles incoming webhook requests from Stripe: verifies the signature
+    and stores the event in the inbox. Processing happens later, in a worker.
+
+    Parameters:
+    request: The incoming request containing the webhook data.
+    gateway: The PaymentGateway holding the webhook secret.
+    db: The database session object used for committing.
+
+    Returns:
+    The Stripe event id, to be handed to the worker.
+    """
     payload = request.data
     sig_header = request.headers['STRIPE_SIGNATURE']
 
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
-        )
+        event = construct_webhook_event(gateway, payload, sig_header)
     except ValueError as e:
         raise e
-    except stripe.error.SignatureVerificationError as e:
+    except SignatureVerificationError as e:
         raise e
 
-    create_order(event, db)
+    store_webhook_event(db, event["id"], event["type"], payload)
+    db.session.commit()
+    return event["id"]
 
 
-def delete_products_from_basket(product, quantity, db):
-    basket_products = db.session.execute(db.select(BasketProduct)).scalars().all()
+def store_webhook_event(db, event_id, event_type, payload):
+    """
+    Records a verified event in the inbox. Stripe retries of an event that
+    is already stored are ignored.
 
-    for basket_product in basket_products:
-        if basket_product.product_id == product.id:
-            if basket_product.amount <= quantity:
-                db.session.delete(basket_product)
-            db.session.commit()
+    Parameters:
+    db: The database session object.
+    event_id: The Stripe event id.
+    event_type: The Stripe event type, e.g. checkout.session.completed.
+    payload: The raw JSON body of the webhook request.
+
+    Returns:
+    bool: True if the event was new.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8")
+    result = db.session.execute(
+        insert(WebhookEvent)
+        .values(id=event_id, type=event_type, payload=payload, status="pending", attempts=0,
+                received_at=datetime.now(timezone.utc))
+        .on_conflict_do_nothing(index_elements=[WebhookEvent.id])
+    )
+    return result.rowcount == 1
+
+
+def replayable_filter(now):
+    """
+    Builds the WHERE clause selecting the events a worker may claim.
+
+    Parameters:
+    now: The current time.
+
+    Returns:
+    A SQLAlchemy boolean expression: pending or failed events, and events
+    whose claim has timed out.
+    """
+    return WebhookEvent.status.in_(REPLAYABLE_STATUSES) | (
+        (WebhookEvent.status == "processing") & (WebhookEvent.claimed_at < now - WEBHOOK_CLAIM_TIMEOUT)
+    )
+
+
+def claim_webhook_event(db, event_id):
+    """
+    Atomically marks an event as being processed, so that concurrent
+    workers and Stripe retries never process it twice.
+
+    Parameters:
+    db: The database session object.
+    event_id: The Stripe event id.
+
+    Returns:
+    bool: True if this caller owns the event now.
+    """
+    now = datetime.now(timezone.utc)
+    result = db.session.execute(
+        db.update(WebhookEvent)
+        .where(WebhookEvent.id == event_id, replayable_filter(now))
+        .values(status="processing", attempts=WebhookEvent.attempts + 1, claimed_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def set_webhook_event_status(db, event_id, status, error=None):
+    """
+    Records the outcome of processing an event. Not committed.
+
+    Parameters:
+    db: The database session object.
+    event_id: The Stripe event id.
+    status: "processed" or "failed".
+    error: The error message of a failed attempt.
+
+    Returns:
+    None
+    """
+    db.session.execute(
+        db.update(WebhookEvent)
+        .where(WebhookEvent.id == event_id)
+        .values(status=status, error=error, processed_at=datetime.now(timezone.utc))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def process_webhook_event(db, event_id):
+    """
+    Applies a stored event exactly once. The order it creates and the
+    "processed" status are committed in the same transaction.
+
+    Parameters:
+    db: The database session object.
+    event_id: The Stripe event id.
+
+    Returns:
+    bool: True if the event was processed by this call, False if it was
+    already handled, is being handled elsewhere, or failed.
+    """
+    if not claim_webhook_event(db, event_id):
+        return False
+
+    payload = db.session.execute(
+        db.select(WebhookEvent.payload).where(WebhookEvent.id == event_id)
+    ).scalar_one()
+    try:
+        owners = create_order(json.loads(payload), db)
+        set_webhook_event_status(db, event_id, "processed")
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        set_webhook_event_status(db, event_id, "failed", error=repr(e))
+        db.session.commit()
+        return False
+
+    for owner in owners:
+        invalidate_basket_count(owner)
+    return True
+
+
+def find_replayable_events(db, event_type=None):
+    """
+    Lists the stored events that still need processing, oldest first.
+
+    Parameters:
+    db: The database session object used for querying.
+    event_type: Optional Stripe event type to restrict the replay to.
+
+    Returns:
+    A list of Stripe event ids.
+    """
+    query = db.select(WebhookEvent.id).where(replayable_filter(datetime.now(timezone.utc)))
+    if event_type:
+        query = query.where(WebhookEvent.type == event_type)
+    return db.session.execute(query.order_by(WebhookEvent.received_at, WebhookEvent.id)).scalars().all()
+
+
+def delete_products_from_basket(db, quantities):
+    """
+    Removes, in a single DELETE, every basket line of an ordered product
+    whose amount does not exceed the ordered quantity.
+
+    Parameters:
+    db: The database session object.
+    quantities: The {product_id: quantity} mapping of the order.
+
+    Returns:
+    set: The owner keys of the baskets that lost a line.
+    """
+    deleted = db.session.execute(
+        db.delete(BasketProduct)
+        .where(
+            BasketProduct.product_id.in_(quantities),
+            BasketProduct.amount <= db.case(quantities, value=BasketProduct.product_id)
+        )
+        .returning(BasketProduct.user_id, BasketProduct.cookie_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    return {basket_product_owner(row) for row in deleted}
 
 
 
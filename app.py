@@ -1,9 +1,17 @@
+import os
+
 from config import create_app
 from routes import init_routes
+from commands import init_commands
+from scheduler import start_housekeeping
 
-app, login_manager, db, endpoint_secret = create_app()
+app, login_manager, db, gateway = create_app()
 
-init_routes(app, login_manager, db, endpoint_secret)
+init_routes(app, login_manager, db, gateway)
+init_commands(app, db)
 
 if __name__ == "__main__":
+    # The development server is a single process; with the reloader, only its child serves
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_housekeeping(app, db)
     app.run(debug=True, host="0.0.0.0", port=4242)
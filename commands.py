@@ -0,0 +1,86 @@
+import click
+
+from activity.inventory import release_expired_reservations
+from activity.reports import rebuild_sales_rollups
+from activity.search import rebuild_search_index
+from activity.thumbnails import generate_missing_variants
+from activity.webhook import find_replayable_events
+from housekeeping import enable_incremental_vacuum, format_report, run_housekeeping
+from storage import migrate_images_to_store
+from migrations import MIGRATIONS, get_applied_versions, run_migrations
+from worker import replay_webhook_events
+
+
+def init_commands(app, db):
+    @app.cli.command("generate-thumbnails")
+    def generate_thumbnails():
+        """Generate size variants for products that do not have them yet."""
+        count = generate_missing_variants(db)
+        click.echo(f"Generated thumbnails for {count} product(s).")
+
+    @app.cli.command("migrate-images")
+    def migrate_images():
+        """Move product image blobs out of the database into the blob store."""
+        moved_per_table = migrate_images_to_store(db)
+        db.session.commit()
+        for table, moved in moved_per_table.items():
+            click.echo(f"{table}: moved {moved} image(s) to {app.config['IMAGE_STORE_PATH']}.")
+        if db.engine.dialect.name == "sqlite":
+            # Give the pages freed by the dropped blob column back to the filesystem
+            with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                connection.exec_driver_sql("VACUUM")
+
+    @app.cli.command("db-upgrade")
+    def db_upgrade():
+        """Apply pending schema migrations."""
+        applied = run_migrations(db)
+        for m in applied:
+            click.echo(f"Applied {m.version}: {m.name}")
+        if not applied:
+            click.echo("Database is up to date.")
+
+    @app.cli.command("db-status")
+    def db_status():
+        """List schema migrations and whether they have been applied."""
+        applied = get_applied_versions(db)
+        for m in MIGRATIONS:
+            click.echo(f"[{'x' if m.version in applied else ' '}] {m.version}: {m.name}")
+
+    @app.cli.command("rebuild-search-index")
+    def rebuild_search():
+        """Rebuild the full-text product search index from the products table."""
+        count = rebuild_search_index(db)
+        db.session.commit()
+        click.echo(f"Indexed {count} product(s).")
+
+    @app.cli.command("rebuild-sales-rollups")
+    def rebuild_sales():
+        """Recompute the daily sales rollups from the orders."""
+        count = rebuild_sales_rollups(db)
+        db.session.commit()
+        click.echo(f"Rolled up {count} order(s).")
+
+    @app.cli.command("webhook-replay")
+    @click.option("--type", "event_type", default=None, help="Only replay events of this Stripe type.")
+    @click.option("--workers", default=4, show_default=True, help="Events processed concurrently.")
+    def webhook_replay(event_type, workers):
+        """Process stored webhook events that are pending, failed or stuck."""
+        event_ids = find_replayable_events(db, event_type)
+        processed = replay_webhook_events(app, db, event_ids, workers)
+        click.echo(f"Processed {processed} of {len(event_ids)} event(s).")
+
+    @app.cli.command("release-reservations")
+    def release_reservations():
+        """Return the stock of expired checkout reservations."""
+        released = release_expired_reservations(db)
+        db.session.commit()
+        click.echo(f"Released {released} reservation line(s).")
+
+    @app.cli.command("housekeeping")
+    @click.option("--enable-incremental-vacuum", "incremental", is_flag=True,
+                  help="Switch SQLite to auto_vacuum=INCREMENTAL first (rewrites the database once).")
+    def housekeeping(incremental):
+        """Purge stale guest baskets and expired reservations, then optimize the database."""
+        if incremental and db.engine.dialect.name == "sqlite":
+            enable_incremental_vacuum(db)
+        click.echo(format_report(run_housekeeping(db, app.config)))
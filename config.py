@@ -2,17 +2,47 @@ from flask import Flask
 from flask_ckeditor import CKEditor
 from flask_bootstrap import Bootstrap5
 from models import db
+from migrations import run_migrations
+from worker import init_webhook_worker
+from scheduler import start_housekeeping
 import os
-import stripe
 from flask_login import LoginManager
+from payments import create_gateway
 
-stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
 endpoint_secret = os.environ.get("STRIPE_WEBHOOK_SECRET")
 
 def create_app():
     app = Flask(__name__)
     app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "sadjfh98w7eh32ijfnijof2h3iofh23ijofhi3h2")
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("SQLALCHEMY_DATABASE_URI", "sqlite:///databse.db")
+    app.config["IMAGE_CACHE_MAX_AGE"] = int(os.environ.get("IMAGE_CACHE_MAX_AGE", 3600))
+    app.config["IMAGE_STORE_PATH"] = os.environ.get("IMAGE_STORE_PATH", os.path.join(app.instance_path, "images"))
+    app.config["CATALOG_PAGE_SIZE"] = int(os.environ.get("CATALOG_PAGE_SIZE", 24))
+    app.config["WAREHOUSE_PAGE_SIZE"] = int(os.environ.get("WAREHOUSE_PAGE_SIZE", 100))
+    app.config["AUTO_MIGRATE"] = os.environ.get("AUTO_MIGRATE", "1") == "1"
+    app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+    # Stripe accepts 30 minutes to 24 hours; stock stays reserved for as long
+    app.config["CHECKOUT_SESSION_TTL"] = int(os.environ.get("CHECKOUT_SESSION_TTL", 3600))
+    app.config["STRIPE_SECRET_KEY"] = os.environ.get("STRIPE_SECRET_KEY")
+    # Points the Stripe client at another server, e.g. fake_stripe.py for load tests
+    app.config["STRIPE_API_BASE"] = os.environ.get("STRIPE_API_BASE")
+    app.config["STRIPE_CONNECT_TIMEOUT"] = float(os.environ.get("STRIPE_CONNECT_TIMEOUT", 3))
+    app.config["STRIPE_READ_TIMEOUT"] = float(os.environ.get("STRIPE_READ_TIMEOUT", 10))
+    app.config["STRIPE_MAX_NETWORK_RETRIES"] = int(os.environ.get("STRIPE_MAX_NETWORK_RETRIES", 2))
+    app.config["STRIPE_POOL_SIZE"] = int(os.environ.get("STRIPE_POOL_SIZE", 10))
+    app.config["STRIPE_BREAKER_THRESHOLD"] = int(os.environ.get("STRIPE_BREAKER_THRESHOLD", 5))
+    app.config["STRIPE_BREAKER_RESET"] = float(os.environ.get("STRIPE_BREAKER_RESET", 30))
+    # Seconds between housekeeping runs; 0 leaves it to `flask housekeeping`
+    app.config["HOUSEKEEPING_INTERVAL"] = int(os.environ.get("HOUSEKEEPING_INTERVAL", 3600))
+    # Set in exactly one server process; CLI commands and other workers never run the scheduler
+    app.config["RUN_SCHEDULER"] = os.environ.get("RUN_SCHEDULER") == "1"
+    app.config["GUEST_BASKET_MAX_AGE_DAYS"] = int(os.environ.get("GUEST_BASKET_MAX_AGE_DAYS", 30))
+    app.config["HOUSEKEEPING_BATCH_SIZE"] = int(os.environ.get("HOUSEKEEPING_BATCH_SIZE", 500))
+    app.config["HOUSEKEEPING_VACUUM_PAGES"] = int(os.environ.get("HOUSEKEEPING_VACUUM_PAGES", 2000))
+    # Seconds an unreferenced image blob is kept, covering uploads not yet committed
+    app.config["HOUSEKEEPING_BLOB_GRACE"] = int(os.environ.get("HOUSEKEEPING_BLOB_GRACE", 3600))
+    # 0 processes webhook events inline, in the request that received them
+    app.config["WEBHOOK_WORKERS"] = int(os.environ.get("WEBHOOK_WORKERS", 4))
     db.init_app(app)
     CKEditor(app)
     Bootstrap5(app)
@@ -21,6 +51,14 @@ def create_app():
 
     with app.app_context():
         db.create_all()
+        # create_all never alters existing tables; bring them up to date
+        if app.config["AUTO_MIGRATE"]:
+            run_migrations(db)
 
+    init_webhook_worker(app)
+    if app.config["RUN_SCHEDULER"]:
+        start_housekeeping(app, db)
 
-    return app, login_manager, db, endpoint_secret
+    gateway = create_gateway(app.config, endpoint_secret)
+
+    return app, login_manager, db, gateway
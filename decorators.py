@@ -1,25 +1,28 @@
+import asyncio
+import inspect
 from functools import wraps
 from flask import session, abort
 from flask_login import current_user
-from models import BasketProduct
+from activity.basket import basket_owner, get_basket_count, touch_session_cookie
+
+def load_basket_amount():
+    from app import db
+    if not current_user.is_authenticated:
+        touch_session_cookie(db, session)
+    return get_basket_count(db, basket_owner(current_user, session))
 
 def get_data(f):
+    if inspect.iscoroutinefunction(f):
+        # Async views keep the database work off their event loop
+        @wraps(f)
+        async def async_decorator_function(*args, **kwargs):
+            kwargs['amount'] = await asyncio.to_thread(load_basket_amount)
+            return await f(*args, **kwargs)
+        return async_decorator_function
+
     @wraps(f)
     def decorator_function(*args, **kwargs):
-        logged_in = current_user.is_authenticated
-        from app import db
-        if not logged_in:
-            if "user_id" not in session:
-                amount = 0
-            else:
-                basket_products = db.session.execute(db.select(BasketProduct).where(BasketProduct.cookie_id == session["user_id"])).scalars().all()
-                basket_products = [basket_products for basket_product in basket_products if basket_product.product.amount >= 1]
-                amount = len(basket_products)
-        else:
-            basket_products = db.session.execute(db.select(BasketProduct).where(BasketProduct.user_id == current_user.id)).scalars().all()
-            basket_products = [basket_products for basket_product in basket_products if basket_product.product.amount >= 1]
-            amount = len(basket_products)
-        kwargs['amount'] = amount
+        kwargs['amount'] = load_basket_amount()
         return f(*args, **kwargs)
     return decorator_function
 
@@ -0,0 +1,229 @@
+"""
+A local stand-in for the parts of the Stripe API the shop uses, so /pay and
+/webhook can be exercised (load tests, CI) without network access.
+
+    python fake_stripe.py --port 12111 --webhook-url http://127.0.0.1:4242/webhook --webhook-secret whsec_test
+    STRIPE_API_BASE=http://127.0.0.1:12111 STRIPE_SECRET_KEY=sk_test_fake STRIPE_WEBHOOK_SECRET=whsec_test python app.py
+
+POST /v1/checkout/sessions creates a session and returns its payment page
+URL. Opening that page "pays": a signed checkout.session.completed event is
+posted to the webhook and the browser is redirected to success_url.
+/checkout/<id>/cancel goes back to cancel_url, as Stripe's back link does;
+POST /v1/checkout/sessions/<id>/expire expires an open session.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+
+SESSION_PATH = re.compile(r"^/v1/checkout/sessions/(?P<id>[\w-]+)$")
+EXPIRE_PATH = re.compile(r"^/v1/checkout/sessions/(?P<id>[\w-]+)/expire$")
+PAGE_PATH = re.compile(r"^/checkout/(?P<id>[\w-]+)(?P<cancel>/cancel)?$")
+KEY_PART = re.compile(r"\[([^\]]*)\]")
+
+
+def parse_form(body):
+    """
+    Decodes Stripe's bracket-encoded form body (line_items[0][quantity]=2) into nested dicts and lists.
+
+    Parameters:
+    body: The urlencoded request body.
+
+    Returns:
+    A dict.
+    """
+    params = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        head = key.split("[", 1)[0]
+        path = [head] + KEY_PART.findall(key[len(head):])
+        node = params
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = value
+    return to_lists(params)
+
+
+def to_lists(node, key=None):
+    """Turns the dicts keyed by "0", "1", ... that parse_form builds into lists; metadata keys stay as they are."""
+    if not isinstance(node, dict):
+        return node
+    if key != "metadata" and node and all(k.isdigit() for k in node):
+        return [to_lists(node[k]) for k in sorted(node, key=int)]
+    return {k: to_lists(value, k) for k, value in node.items()}
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """
+    Builds a Stripe-Signature header for a webhook payload.
+
+    Parameters:
+    payload: The JSON body as a string.
+    secret: The webhook signing secret.
+    timestamp: The signing time, defaults to now.
+
+    Returns:
+    The header value.
+    """
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+class FakeStripe:
+    """Holds the checkout sessions and delivers their webhook events."""
+
+    def __init__(self, public_url, webhook_url, webhook_secret):
+        self.public_url = public_url
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.http = requests.Session()
+
+    def create_session(self, params):
+        session_id = "cs_test_" + secrets.token_hex(12)
+        amount_total = sum(
+            int(item["price_data"]["unit_amount"]) * int(item.get("quantity", 1))
+            for item in params.get("line_items", [])
+        )
+        checkout_session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"{self.public_url}/checkout/{session_id}",
+            "status": "open",
+            "payment_status": "unpaid",
+            "amount_total": amount_total,
+            "currency": "pln",
+            "client_reference_id": params.get("client_reference_id"),
+            "metadata": params.get("metadata", {}),
+            "expires_at": int(params.get("expires_at") or time.time() + 24 * 3600),
+            "success_url": params.get("success_url"),
+            "cancel_url": params.get("cancel_url"),
+            "shipping_details": None,
+        }
+        with self.lock:
+            self.sessions[session_id] = checkout_session
+        return checkout_session
+
+    def finish_session(self, session_id, paid):
+        with self.lock:
+            checkout_session = self.sessions.get(session_id)
+            if checkout_session is None or checkout_session["status"] != "open":
+                return checkout_session
+            if paid:
+                checkout_session.update(status="complete", payment_status="paid", shipping_details={
+                    "name": "Jan Kowalski",
+                    "address": {"city": "Warszawa", "country": "PL", "line1": "ul. Testowa 1",
+                                "line2": None, "postal_code": "00-001", "state": None},
+                })
+            else:
+                checkout_session["status"] = "expired"
+        self.send_event("checkout.session.completed" if paid else "checkout.session.expired", checkout_session)
+        return checkout_session
+
+    def send_event(self, event_type, data_object):
+        if not self.webhook_url:
+            return
+        payload = json.dumps({
+            "id": "evt_test_" + secrets.token_hex(12),
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "livemode": False,
+            "data": {"object": data_object},
+        })
+        headers = {"Content-Type": "application/json", "Stripe-Signature": sign_payload(payload, self.webhook_secret)}
+        try:
+            self.http.post(self.webhook_url, data=payload, headers=headers, timeout=10)
+        except requests.RequestException as e:
+            # Stripe would retry later; the fake only reports it
+            print(f"Delivering {event_type} to {self.webhook_url} failed: {e}")
+
+
+def make_handler(stripe):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_redirect(self, url):
+            self.send_response(303)
+            self.send_header("Location", url)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def not_found(self):
+            self.send_json(404, {"error": {"type": "invalid_request_error", "message": "Unrecognized request URL"}})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+            path = urlparse(self.path).path
+            match = EXPIRE_PATH.match(path)
+            if match:
+                checkout_session = stripe.sessions.get(match["id"])
+                if checkout_session is None:
+                    return self.not_found()
+                if checkout_session["status"] != "open":
+                    return self.send_json(400, {"error": {
+                        "type": "invalid_request_error",
+                        "message": "Only Checkout Sessions with a status in [\"open\"] can be expired.",
+                    }})
+                return self.send_json(200, stripe.finish_session(match["id"], paid=False))
+            if path != "/v1/checkout/sessions":
+                return self.not_found()
+            self.send_json(200, stripe.create_session(parse_form(body)))
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            match = SESSION_PATH.match(path)
+            if match:
+                checkout_session = stripe.sessions.get(match["id"])
+                return self.send_json(200, checkout_session) if checkout_session else self.not_found()
+            match = PAGE_PATH.match(path)
+            if match:
+                if match["cancel"]:
+                    checkout_session = stripe.sessions.get(match["id"])
+                else:
+                    checkout_session = stripe.finish_session(match["id"], paid=True)
+                if checkout_session is None:
+                    return self.not_found()
+                return self.send_redirect(checkout_session["cancel_url" if match["cancel"] else "success_url"])
+            self.not_found()
+
+        def log_message(self, format, *args):
+            # Stay quiet under load
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Stripe checkout API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--webhook-url", default="http://127.0.0.1:4242/webhook")
+    parser.add_argument("--webhook-secret", default="whsec_test")
+    args = parser.parse_args()
+
+    stripe = FakeStripe(f"http://{args.host}:{args.port}", args.webhook_url, args.webhook_secret)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(stripe))
+    print(f"Fake Stripe listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileRequired
-from wtforms import StringField, IntegerField, SubmitField, FileField, SelectField
+from wtforms import StringField, IntegerField, SubmitField, FileField, SelectField, HiddenField
 from wtforms.validators import DataRequired
 from flask_ckeditor import CKEditorField
 
@@ -19,6 +19,8 @@ class FormProductForEdit(FlaskForm):
     description = CKEditorField("description", validators=[DataRequired()])
     price = IntegerField("price", validators=[DataRequired()])
     amount = IntegerField("amount", validators=[DataRequired()])
+    # The available amount the form was rendered with; the edit is applied as a change from it
+    amount_seen = HiddenField("amount_seen")
     location = StringField("location", validators=[DataRequired()])
     category = SelectField("category", choices=[], validators=[DataRequired()])
     image = FileField("image")
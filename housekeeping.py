@@ -0,0 +1,218 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from models import BasketProduct, Cookie, Product, ProductImageVariant
+from activity.inventory import release_expired_reservations
+
+
+def purge_stale_cookies(db, cutoff, batch_size=500):
+    """
+    Deletes guest cookies not seen since the cutoff, together with their baskets.
+
+    Works in batches, each in its own short transaction, so the database
+    is never write-locked for long.
+
+    Parameters:
+    db: The database object.
+    cutoff: Cookies last seen before this time are deleted.
+    batch_size: How many cookies are deleted per transaction.
+
+    Returns:
+    A tuple (cookies, basket_products) with the number of rows deleted.
+    """
+    cookies = basket_products = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Cookie.id).where(Cookie.last_seen < cutoff).order_by(Cookie.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        basket_products += db.session.execute(
+            db.delete(BasketProduct).where(BasketProduct.cookie_id.in_(ids))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        cookies += db.session.execute(
+            db.delete(Cookie).where(Cookie.id.in_(ids)).execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+    return cookies, basket_products
+
+
+def purge_orphan_basket_products(db, batch_size=500):
+    """
+    Deletes abandoned basket lines: lines whose cookie or product no longer
+    exists, and lines that belong to nobody.
+
+    Parameters:
+    db: The database object.
+    batch_size: How many lines are deleted per transaction.
+
+    Returns:
+    The number of basket lines deleted.
+    """
+    orphan = (
+        (BasketProduct.user_id.is_(None) & BasketProduct.cookie_id.is_(None))
+        | (BasketProduct.cookie_id.is_not(None) & ~db.select(Cookie.id).where(Cookie.id == BasketProduct.cookie_id).exists())
+        | ~db.select(Product.id).where(Product.id == BasketProduct.product_id).exists()
+    )
+    deleted = 0
+    while True:
+        ids = db.session.execute(
+            db.select(BasketProduct.id).where(orphan).order_by(BasketProduct.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        deleted += db.session.execute(
+            db.delete(BasketProduct).where(BasketProduct.id.in_(ids)).execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+    return deleted
+
+
+def purge_unused_blobs(db, root, grace_seconds):
+    """
+    Deletes image blobs no product or image variant refers to any more,
+    e.g. after an image was replaced or a product deleted.
+
+    A blob is written before the row naming it is committed, so files
+    younger than grace_seconds are kept (store_blob refreshes the time of
+    a blob it reuses). Temporary files left by an interrupted write go too.
+
+    Parameters:
+    db: The database object.
+    root: The blob store directory (IMAGE_STORE_PATH).
+    grace_seconds: How old an unreferenced file must be to be deleted.
+
+    Returns:
+    A tuple (blobs, bytes) with the number of files deleted and their size.
+    """
+    if not os.path.isdir(root):
+        return 0, 0
+    cutoff = time.time() - grace_seconds
+    used = set(db.session.execute(db.select(Product.image_hash)).scalars())
+    used.update(db.session.execute(db.select(ProductImageVariant.image_hash)).scalars())
+    db.session.rollback()  # Release the read transaction before walking the disk
+
+    blobs = freed = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name in used:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime >= cutoff:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            blobs += 1
+            freed += stat.st_size
+    return blobs, freed
+
+
+def optimize_sqlite(db, vacuum_pages):
+    """
+    Refreshes the query planner statistics and gives free pages back to the
+    filesystem. Incremental vacuum only works once the database uses
+    auto_vacuum=INCREMENTAL (see enable_incremental_vacuum).
+
+    Parameters:
+    db: The database object.
+    vacuum_pages: The most pages one run may release.
+
+    Returns:
+    A dict with page_size, the pages still on the freelist, and the bytes the file shrank by.
+    """
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        def pragma(name):
+            return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+        page_size = pragma("page_size")
+        pages_before = pragma("page_count")
+        # Bounded sampling keeps ANALYZE cheap on large tables
+        connection.exec_driver_sql("PRAGMA analysis_limit=1000")
+        connection.exec_driver_sql("ANALYZE")
+        if pragma("auto_vacuum") == 2:
+            # The pragma frees one page per step; executescript steps it to completion
+            connection.connection.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+        pages_after = pragma("page_count")
+        free_pages = pragma("freelist_count")
+    return {
+        "page_size": page_size,
+        "free_pages_after": free_pages,
+        "freed_bytes": max(pages_before - pages_after, 0) * page_size,
+    }
+
+
+def enable_incremental_vacuum(db):
+    """
+    Switches a SQLite database to auto_vacuum=INCREMENTAL. This rewrites the
+    whole file once (VACUUM), so run it during a quiet period.
+
+    Parameters:
+    db: The database object.
+
+    Returns:
+    None
+    """
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+
+
+def run_housekeeping(db, config):
+    """
+    Runs every cleanup job once.
+
+    Parameters:
+    db: The database object.
+    config: The application config (GUEST_BASKET_MAX_AGE_DAYS, HOUSEKEEPING_BATCH_SIZE,
+        HOUSEKEEPING_VACUUM_PAGES, IMAGE_STORE_PATH and HOUSEKEEPING_BLOB_GRACE).
+
+    Returns:
+    A dict describing what was reclaimed.
+    """
+    batch_size = config["HOUSEKEEPING_BATCH_SIZE"]
+    cutoff = datetime.now(timezone.utc) - timedelta(days=config["GUEST_BASKET_MAX_AGE_DAYS"])
+
+    cookies, basket_products = purge_stale_cookies(db, cutoff, batch_size)
+    orphans = purge_orphan_basket_products(db, batch_size)
+    reservations = release_expired_reservations(db)
+    db.session.commit()
+    blobs, blob_bytes = purge_unused_blobs(db, config["IMAGE_STORE_PATH"], config["HOUSEKEEPING_BLOB_GRACE"])
+
+    report = {
+        "cookies": cookies,
+        "basket_products": basket_products + orphans,
+        "reservations": reservations,
+        "blobs": blobs,
+        "blob_bytes": blob_bytes,
+    }
+    if db.engine.dialect.name == "sqlite":
+        report.update(optimize_sqlite(db, config["HOUSEKEEPING_VACUUM_PAGES"]))
+    return report
+
+
+def format_report(report):
+    """
+    Formats a housekeeping report for logs and the CLI.
+
+    Parameters:
+    report: The dict returned by run_housekeeping.
+
+    Returns:
+    A one-line summary.
+    """
+    summary = (
+        f"Deleted {report['cookies']} stale cookie(s) and {report['basket_products']} basket line(s), "
+        f"released {report['reservations']} reservation line(s), "
+        f"removed {report['blobs']} unused image blob(s) ({report['blob_bytes']} byte(s))"
+    )
+    if "freed_bytes" in report:
+        summary += (
+            f", freed {report['freed_bytes']} byte(s) "
+            f"({report['free_pages_after']} free page(s) left)"
+        )
+    return summary + "."
@@ -0,0 +1,237 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from sqlalchemy import inspect, text
+
+from models import Cookie, Order, OrderItem, Product, SchemaMigration
+from activity.reports import rebuild_sales_rollups
+from activity.search import rebuild_search_index
+from activity.webhook import parse_order_body
+from storage import migrate_images_to_store
+
+# db.create_all() only creates missing tables; every change to a table that
+# already exists in production goes through a numbered migration below.
+# Migrations must be idempotent: on a fresh database create_all has already
+# built the final schema and they are simply recorded as applied.
+Migration = namedtuple("Migration", ["version", "name", "apply"])
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """
+    Registers a function as the schema migration with the given version.
+
+    Parameters:
+    version: The migration number; migrations run in ascending order.
+    name: A short description stored in the schemaMigrations table.
+
+    Returns:
+    The decorator.
+    """
+    def decorator(f):
+        MIGRATIONS.append(Migration(version, name, f))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return f
+    return decorator
+
+
+def get_columns(db, table):
+    """
+    Lists the column names of a table, as seen by the current transaction.
+
+    Parameters:
+    db: The database object.
+    table: The table name.
+
+    Returns:
+    A set of column names.
+    """
+    return {column["name"] for column in inspect(db.session.connection()).get_columns(table)}
+
+
+def execute_all(db, statements):
+    """
+    Executes a list of SQL statements in the current transaction.
+
+    Parameters:
+    db: The database object.
+    statements: The SQL strings to execute.
+
+    Returns:
+    None
+    """
+    for statement in statements:
+        db.session.execute(text(statement))
+
+
+@migration(1, "Move product images to the blob store")
+def move_images_to_blob_store(db):
+    migrate_images_to_store(db)
+
+
+@migration(2, "Index hot foreign keys and filter columns")
+def add_hot_indexes(db):
+    execute_all(db, [
+        'CREATE INDEX IF NOT EXISTS "ix_basketProducts_user_id" ON "basketProducts" (user_id)',
+        'CREATE INDEX IF NOT EXISTS "ix_basketProducts_cookie_id" ON "basketProducts" (cookie_id)',
+        'CREATE INDEX IF NOT EXISTS "ix_basketProducts_product_id" ON "basketProducts" (product_id)',
+        'CREATE INDEX IF NOT EXISTS ix_products_category_id_price ON products (category_id, price)',
+        'CREATE INDEX IF NOT EXISTS ix_products_price ON products (price)',
+        'CREATE INDEX IF NOT EXISTS ix_orders_status ON orders (status)',
+    ])
+
+
+@migration(3, "Unique user email and username")
+def unique_user_email_and_username(db):
+    for column in ("email", "username"):
+        duplicates = db.session.execute(
+            text(f"SELECT {column} FROM users GROUP BY {column} HAVING COUNT(*) > 1")
+        ).scalars().all()
+        if duplicates:
+            raise RuntimeError(f"Cannot make users.{column} unique, duplicated values: {', '.join(duplicates)}")
+    execute_all(db, [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)",
+    ])
+
+
+@migration(4, "Full-text search index over product names and descriptions")
+def create_search_index(db):
+    rebuild_search_index(db)
+
+
+@migration(5, "Track when guest cookies were last seen")
+def add_cookie_last_seen(db):
+    if "last_seen" not in get_columns(db, "cookies"):
+        db.session.execute(text("ALTER TABLE cookies ADD COLUMN last_seen DATETIME"))
+    # Existing guests get a full grace period from now on
+    db.session.execute(
+        db.update(Cookie).where(Cookie.last_seen.is_(None)).values(last_seen=datetime.now(timezone.utc))
+    )
+    execute_all(db, ["CREATE INDEX IF NOT EXISTS ix_cookies_last_seen ON cookies (last_seen)"])
+
+
+@migration(6, "One basket line per owner and product")
+def unique_basket_lines(db):
+    for owner in ("user_id", "cookie_id"):
+        # Fold duplicated lines into the oldest one before the unique index can be built
+        execute_all(db, [
+            f"""UPDATE "basketProducts" SET amount = (
+                    SELECT SUM(d.amount) FROM "basketProducts" d
+                    WHERE d.{owner} = "basketProducts".{owner} AND d.product_id = "basketProducts".product_id)
+                WHERE {owner} IS NOT NULL AND id IN (
+                    SELECT MIN(id) FROM "basketProducts" WHERE {owner} IS NOT NULL
+                    GROUP BY {owner}, product_id HAVING COUNT(*) > 1)""",
+            f"""DELETE FROM "basketProducts"
+                WHERE {owner} IS NOT NULL AND id NOT IN (
+                    SELECT MIN(id) FROM "basketProducts" WHERE {owner} IS NOT NULL GROUP BY {owner}, product_id)""",
+        ])
+    execute_all(db, [
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_basketProducts_user_id_product_id" ON "basketProducts" (user_id, product_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_basketProducts_cookie_id_product_id" ON "basketProducts" (cookie_id, product_id)',
+        # Both are prefixes of the unique indexes
+        'DROP INDEX IF EXISTS "ix_basketProducts_user_id"',
+        'DROP INDEX IF EXISTS "ix_basketProducts_cookie_id"',
+    ])
+
+
+@migration(7, "Order line items backfilled from the order body")
+def backfill_order_items(db, batch_size=500):
+    has_items = db.select(OrderItem.id).where(OrderItem.order_id == Order.id).exists()
+    last_id = 0
+    while True:
+        orders = db.session.execute(
+            db.select(Order.id, Order.body).where(Order.id > last_id, ~has_items).order_by(Order.id).limit(batch_size)
+        ).all()
+        if not orders:
+            break
+        items = [(order.id, item) for order in orders for item in parse_order_body(order.body)]
+        # The price paid was never recorded; today's price is the best guess, unknown for deleted products
+        prices = dict(db.session.execute(
+            db.select(Product.id, Product.price).where(Product.id.in_({item[0] for _, item in items}))
+        ).all())
+        if items:
+            db.session.execute(db.insert(OrderItem), [
+                {"order_id": order_id, "product_id": product_id, "name": name,
+                 "unit_price": prices.get(product_id), "quantity": quantity}
+                for order_id, (product_id, name, quantity) in items
+            ])
+        last_id = orders[-1].id
+
+
+@migration(8, "Order payment time and daily sales rollups")
+def add_sales_rollups(db):
+    if "created_at" not in get_columns(db, "orders"):
+        # Earlier orders never recorded it and stay out of the rollups
+        db.session.execute(text("ALTER TABLE orders ADD COLUMN created_at DATETIME"))
+    execute_all(db, ["CREATE INDEX IF NOT EXISTS ix_orders_created_at ON orders (created_at)"])
+    rebuild_sales_rollups(db)
+
+
+@migration(9, "Never reuse guest cookie IDs")
+def autoincrement_cookie_ids(db):
+    table_sql = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'cookies'")
+    ).scalar_one()
+    if "AUTOINCREMENT" in table_sql.upper():
+        return
+    # SQLite cannot add AUTOINCREMENT to a table; rebuild it with the same rows
+    execute_all(db, [
+        "CREATE TABLE cookies_new (id INTEGER PRIMARY KEY AUTOINCREMENT, last_seen DATETIME)",
+        "INSERT INTO cookies_new (id, last_seen) SELECT id, last_seen FROM cookies",
+        "DROP TABLE cookies",
+        "ALTER TABLE cookies_new RENAME TO cookies",
+        "CREATE INDEX IF NOT EXISTS ix_cookies_last_seen ON cookies (last_seen)",
+    ])
+
+
+def get_applied_versions(db):
+    """
+    Returns the versions already recorded in the schemaMigrations table.
+
+    Parameters:
+    db: The database object.
+
+    Returns:
+    A set of migration numbers.
+    """
+    return set(db.session.execute(db.select(SchemaMigration.version)).scalars().all())
+
+
+def get_pending_migrations(db):
+    """
+    Lists the migrations that have not been applied to this database yet.
+
+    Parameters:
+    db: The database object.
+
+    Returns:
+    A list of Migration tuples, in the order they must run.
+    """
+    applied = get_applied_versions(db)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def run_migrations(db):
+    """
+    Applies every pending migration, each one in its own transaction.
+
+    Every migration only adds indexes or moves data in bounded batches, so
+    the application keeps serving while they run.
+
+    Parameters:
+    db: The database object.
+
+    Returns:
+    The list of Migration tuples that were applied.
+    """
+    pending = get_pending_migrations(db)
+    for m in pending:
+        try:
+            m.apply(db)
+            db.session.add(SchemaMigration(version=m.version, name=m.name, applied_at=datetime.now(timezone.utc)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return pending
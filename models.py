@@ -6,8 +6,8 @@ db = SQLAlchemy()
 class User(db.Model, UserMixin):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(20), nullable=False)
-    email = db.Column(db.String, nullable=False)
+    username = db.Column(db.String(20), nullable=False, unique=True, index=True)
+    email = db.Column(db.String, nullable=False, unique=True, index=True)
     password = db.Column(db.String, nullable=False)
     permission = db.Column(db.Integer, nullable=False)
     products = db.relationship("Product", back_populates="owner")
@@ -16,7 +16,11 @@ class User(db.Model, UserMixin):
 class Cookie(db.Model):
     __tablename__ = "cookies"
     id = db.Column(db.Integer, primary_key=True)
+    # Refreshed at most once per COOKIE_TOUCH_INTERVAL; stale guest baskets are purged by housekeeping
+    last_seen = db.Column(db.DateTime, nullable=True, index=True)
     basket_products = db.relationship("BasketProduct", back_populates="cookie")
+    # Sessions hold the ID, so an ID must never be handed out twice, even after its row was deleted
+    __table_args__ = {"sqlite_autoincrement": True}
 
 
 class Product(db.Model):
@@ -30,11 +34,29 @@ class Product(db.Model):
     amount = db.Column(db.Integer, nullable=False)
     status = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Integer, nullable=False)
-    image = db.Column(db.LargeBinary, nullable=False)
+    # SHA-256 of the original image in the content-addressed store (see storage.py)
+    image_hash = db.Column(db.String(64), nullable=False)
     image_mimetype = db.Column(db.String, nullable=False)
     owner = db.relationship("User", back_populates="products")
     basketProducts = db.relationship("BasketProduct", back_populates="product")
     category = db.relationship("Category", back_populates="products")
+    image_variants = db.relationship("ProductImageVariant", back_populates="product", cascade="all, delete-orphan")
+    __table_args__ = (
+        # Also serves plain category_id lookups, so category_id needs no index of its own
+        db.Index("ix_products_category_id_price", "category_id", "price"),
+        db.Index("ix_products_price", "price"),
+    )
+
+class ProductImageVariant(db.Model):
+    __tablename__ = "productImageVariants"
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey("products.id"), nullable=False)
+    size = db.Column(db.String, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    image_hash = db.Column(db.String(64), nullable=False)
+    image_mimetype = db.Column(db.String, nullable=False)
+    product = db.relationship("Product", back_populates="image_variants")
+    __table_args__ = (db.UniqueConstraint("product_id", "size"),)
 
 class Category(db.Model):
     __tablename__ = "categories"
@@ -45,13 +67,19 @@ class Category(db.Model):
 class BasketProduct(db.Model):
     __tablename__ = "basketProducts"
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey("products.id"))
+    product_id = db.Column(db.Integer, db.ForeignKey("products.id"), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     cookie_id = db.Column(db.Integer, db.ForeignKey("cookies.id"))
     amount = db.Column(db.Integer, nullable=False)
     product = db.relationship("Product", back_populates="basketProducts")
     user = db.relationship("User", back_populates="basketProducts")
     cookie = db.relationship("Cookie", back_populates="basket_products")
+    # One line per product per basket; adding to the basket upserts against these.
+    # NULLs never collide, so user lines and guest lines each use their own index.
+    __table_args__ = (
+        db.Index("ix_basketProducts_user_id_product_id", "user_id", "product_id", unique=True),
+        db.Index("ix_basketProducts_cookie_id_product_id", "cookie_id", "product_id", unique=True),
+    )
 
 class Order(db.Model):
     __tablename__ = "orders"
@@ -61,6 +89,101 @@ class Order(db.Model):
     line_1 = db.Column(db.String, nullable=False)
     line_2 = db.Column(db.String, nullable=True)
     postal_code = db.Column(db.String, nullable=False)
+    # Legacy free-text summary of the items, still written for older readers; use items instead
     body = db.Column(db.String, nullable=False)
     amount_total = db.Column(db.Integer, nullable=False)
-    status = db.Column(db.String, nullable=False)
\ No newline at end of file
+    status = db.Column(db.String, nullable=False, index=True)
+    # When the payment completed (UTC); NULL for orders placed before it was recorded
+    created_at = db.Column(db.DateTime, nullable=True, index=True)
+    items = db.relationship("OrderItem", back_populates="order", order_by="OrderItem.id")
+
+class OrderItem(db.Model):
+    __tablename__ = "orderItems"
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey("orders.id"), nullable=False, index=True)
+    # Products can be deleted later; name and unit_price are snapshots taken when the order was paid
+    product_id = db.Column(db.Integer, db.ForeignKey("products.id"), nullable=False, index=True)
+    name = db.Column(db.String, nullable=False)
+    # Unknown (NULL) for items backfilled from orders whose product no longer exists
+    unit_price = db.Column(db.Integer, nullable=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    order = db.relationship("Order", back_populates="items")
+
+# Sales rollups, one row per UTC day (and product or category). The webhook
+# adds every paid order to them; `flask rebuild-sales-rollups` recomputes them
+# from orders and orderItems. Revenue is unit_price * quantity, in zł.
+class SalesDay(db.Model):
+    __tablename__ = "salesDays"
+    day = db.Column(db.Date, primary_key=True)
+    revenue = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+
+class SalesDayProduct(db.Model):
+    __tablename__ = "salesDayProducts"
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # A name the product was sold under that day
+    name = db.Column(db.String, nullable=False)
+    revenue = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+
+class SalesDayCategory(db.Model):
+    __tablename__ = "salesDayCategories"
+    day = db.Column(db.Date, primary_key=True)
+    # 0 for products without a category, so the key never holds NULL
+    category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    revenue = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+
+class SchemaMigration(db.Model):
+    __tablename__ = "schemaMigrations"
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+class CacheVersion(db.Model):
+    __tablename__ = "cacheVersions"
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+class WebhookEvent(db.Model):
+    __tablename__ = "webhookEvents"
+    # Stripe event id, so a retried delivery maps onto the same row
+    id = db.Column(db.String, primary_key=True)
+    type = db.Column(db.String, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String, nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.DateTime, nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+class StockReservation(db.Model):
+    __tablename__ = "stockReservations"
+    id = db.Column(db.Integer, primary_key=True)
+    # Shared by every line of one checkout; sent to Stripe as client_reference_id
+    token = db.Column(db.String, nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey("products.id"), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index("ix_stockReservations_status_expires_at", "status", "expires_at"),
+    )
+
+class CheckoutSession(db.Model):
+    __tablename__ = "checkoutSessions"
+    id = db.Column(db.Integer, primary_key=True)
+    # At most one open Stripe session per basket: "user:<id>" or "cookie:<id>"
+    owner = db.Column(db.String, nullable=False, unique=True, index=True)
+    # sha256 of the owner and the (product, quantity, price) lines the session was created for
+    fingerprint = db.Column(db.String(64), nullable=False)
+    stripe_session_id = db.Column(db.String, nullable=False)
+    url = db.Column(db.String, nullable=False)
+    reservation_token = db.Column(db.String, nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,291 @@
+import asyncio
+import threading
+import time
+from collections import namedtuple
+
+import requests
+import stripe
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Everything the app asks of Stripe goes through a PaymentGateway: one
+# StripeClient with a pooled HTTP session, bounded timeouts and automatic
+# retries (exponential backoff with jitter, idempotency keys added by the
+# library), guarded by a circuit breaker so a Stripe outage fails /pay fast
+# instead of tying up every worker thread. Async calls go out through an
+# httpx connection pool living on the gateway's own event loop thread.
+PaymentGateway = namedtuple("PaymentGateway", ["client", "webhook_secret", "breaker", "loop"])
+
+# Base class of every Stripe failure the views handle
+PaymentError = stripe.StripeError
+SignatureVerificationError = stripe.SignatureVerificationError
+
+# Failures that say Stripe is unreachable or unhealthy, as opposed to a rejected request
+BREAKER_FAILURES = (stripe.APIConnectionError, stripe.APIError, stripe.RateLimitError)
+
+
+class CircuitOpenError(stripe.StripeError):
+    """Raised instead of calling Stripe while the circuit breaker is open."""
+
+
+def new_circuit_breaker(failure_threshold, reset_timeout):
+    """
+    Creates the state of a circuit breaker.
+
+    After failure_threshold consecutive failures the breaker opens and calls
+    fail immediately; after reset_timeout seconds one trial call is let
+    through, and its outcome closes or re-opens the breaker.
+
+    Parameters:
+    failure_threshold: Consecutive failures that open the breaker.
+    reset_timeout: Seconds the breaker stays open.
+
+    Returns:
+    A dict holding the breaker state.
+    """
+    return {
+        "failure_threshold": failure_threshold,
+        "reset_timeout": reset_timeout,
+        "failures": 0,
+        "opened_at": None,
+        "trial_running": False,
+        "lock": threading.Lock(),
+    }
+
+
+def breaker_allows_call(breaker):
+    """
+    Tells whether a call may go out, claiming the trial call when the breaker is half-open.
+
+    Parameters:
+    breaker: The breaker state.
+
+    Returns:
+    bool: False while the breaker is open.
+    """
+    with breaker["lock"]:
+        if breaker["opened_at"] is None:
+            return True
+        if time.monotonic() - breaker["opened_at"] < breaker["reset_timeout"] or breaker["trial_running"]:
+            return False
+        breaker["trial_running"] = True
+        return True
+
+
+def record_call_result(breaker, failed):
+    """
+    Updates the breaker with the outcome of a call.
+
+    Parameters:
+    breaker: The breaker state.
+    failed: Whether the call failed with one of BREAKER_FAILURES.
+
+    Returns:
+    None
+    """
+    with breaker["lock"]:
+        breaker["trial_running"] = False
+        if not failed:
+            breaker["failures"] = 0
+            breaker["opened_at"] = None
+            return
+        breaker["failures"] += 1
+        if breaker["opened_at"] is not None or breaker["failures"] >= breaker["failure_threshold"]:
+            breaker["opened_at"] = time.monotonic()
+
+
+def start_event_loop():
+    """
+    Starts the event loop the gateway's async calls run on.
+
+    Async views run each request on a short-lived loop of their own; the
+    httpx pool can only be reused from a single loop, so calls are handed
+    over to this one.
+
+    Returns:
+    The running event loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="payments-loop", daemon=True).start()
+    return loop
+
+
+def call_stripe(gateway, f, *args, **kwargs):
+    """
+    Calls the Stripe API through the gateway's circuit breaker.
+
+    Parameters:
+    gateway: The PaymentGateway.
+    f: The StripeClient method to call.
+
+    Returns:
+    Whatever f returns.
+
+    Raises:
+    CircuitOpenError: If the breaker is open.
+    PaymentError: If Stripe failed or rejected the request.
+    """
+    if not breaker_allows_call(gateway.breaker):
+        raise CircuitOpenError("Stripe is unavailable, try again in a moment.")
+    try:
+        result = f(*args, **kwargs)
+    except BREAKER_FAILURES:
+        record_call_result(gateway.breaker, failed=True)
+        raise
+    except BaseException:
+        # The request reached Stripe and was answered; that says nothing about its health
+        record_call_result(gateway.breaker, failed=False)
+        raise
+    record_call_result(gateway.breaker, failed=False)
+    return result
+
+
+async def call_stripe_async(gateway, f, *args, **kwargs):
+    """
+    Awaits an async Stripe API call on the gateway's event loop, through the circuit breaker.
+
+    Parameters:
+    gateway: The PaymentGateway.
+    f: The async StripeClient method to call.
+
+    Returns:
+    Whatever f returns.
+
+    Raises:
+    CircuitOpenError: If the breaker is open.
+    PaymentError: If Stripe failed or rejected the request.
+    """
+    if not breaker_allows_call(gateway.breaker):
+        raise CircuitOpenError("Stripe is unavailable, try again in a moment.")
+    try:
+        result = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(f(*args, **kwargs), gateway.loop))
+    except BREAKER_FAILURES:
+        record_call_result(gateway.breaker, failed=True)
+        raise
+    except BaseException:
+        record_call_result(gateway.breaker, failed=False)
+        raise
+    record_call_result(gateway.breaker, failed=False)
+    return result
+
+
+def create_gateway(config, webhook_secret):
+    """
+    Builds the payment gateway from the application config.
+
+    Parameters:
+    config: The application config (STRIPE_* keys, see config.create_app).
+    webhook_secret: The secret for verifying webhook signatures.
+
+    Returns:
+    A PaymentGateway.
+    """
+    session = requests.Session()
+    # Keep-alive connections are shared by every worker thread
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config["STRIPE_POOL_SIZE"])
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    timeout = (config["STRIPE_CONNECT_TIMEOUT"], config["STRIPE_READ_TIMEOUT"])
+    # Without httpx the async calls raise; the sync ones keep working
+    async_client = None
+    if httpx is not None:
+        async_client = stripe.HTTPXClient(timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+
+    base_addresses = {"api": config["STRIPE_API_BASE"]} if config["STRIPE_API_BASE"] else {}
+    client = stripe.StripeClient(
+        config["STRIPE_SECRET_KEY"] or "",
+        base_addresses=base_addresses,
+        max_network_retries=config["STRIPE_MAX_NETWORK_RETRIES"],
+        http_client=stripe.RequestsClient(
+            session=session,
+            timeout=timeout,
+            async_fallback_client=async_client
+        )
+    )
+    breaker = new_circuit_breaker(config["STRIPE_BREAKER_THRESHOLD"], config["STRIPE_BREAKER_RESET"])
+    return PaymentGateway(client, webhook_secret, breaker, start_event_loop())
+
+
+def create_checkout_session(gateway, params):
+    """
+    Creates a Stripe checkout session.
+
+    Parameters:
+    gateway: The PaymentGateway.
+    params: The parameters of stripe.checkout.Session.create.
+
+    Returns:
+    The checkout session (with "id" and "url").
+    """
+    return call_stripe(gateway, gateway.client.checkout.sessions.create, params=params)
+
+
+async def create_checkout_session_async(gateway, params):
+    """
+    Creates a Stripe checkout session without holding a thread while Stripe answers.
+
+    Parameters:
+    gateway: The PaymentGateway.
+    params: The parameters of stripe.checkout.Session.create.
+
+    Returns:
+    The checkout session (with "id" and "url").
+    """
+    return await call_stripe_async(gateway, gateway.client.checkout.sessions.create_async, params=params)
+
+
+def expire_checkout_session(gateway, session_id):
+    """
+    Expires an open Stripe checkout session, so it can no longer be paid.
+
+    Parameters:
+    gateway: The PaymentGateway.
+    session_id: The ID of the checkout session.
+
+    Returns:
+    The expired checkout session.
+
+    Raises:
+    PaymentError: Also when the session is no longer open (paid or already expired).
+    """
+    return call_stripe(gateway, gateway.client.checkout.sessions.expire, session_id)
+
+
+async def expire_checkout_session_async(gateway, session_id):
+    """
+    Expires an open Stripe checkout session without holding a thread while Stripe answers.
+
+    Parameters:
+    gateway: The PaymentGateway.
+    session_id: The ID of the checkout session.
+
+    Returns:
+    The expired checkout session.
+
+    Raises:
+    PaymentError: Also when the session is no longer open (paid or already expired).
+    """
+    return await call_stripe_async(gateway, gateway.client.checkout.sessions.expire_async, session_id)
+
+
+def construct_webhook_event(gateway, payload, signature):
+    """
+    Verifies the signature of a webhook request and decodes its event. No network call.
+
+    Parameters:
+    gateway: The PaymentGateway.
+    payload: The raw request body.
+    signature: The Stripe-Signature header.
+
+    Returns:
+    The Stripe event.
+
+    Raises:
+    ValueError: If the payload is not valid JSON.
+    SignatureVerificationError: If the signature does not match.
+    """
+    return gateway.client.construct_event(payload, signature, gateway.webhook_secret)
@@ -2,24 +2,39 @@ from flask import render_template, request, redirect, url_for, abort, session, j
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.security import check_password_hash, generate_password_hash
 from forms import FormProduct, InputCategory, DeleteCategoryForm, FormProductForEdit
-from models import User, Product, Category, BasketProduct, Order
-from base64 import b64encode
-import stripe
+from models import User, Product, BasketProduct, Order
 from activity.products import get_products
 from activity.product import get_product, check_if_is_product
-from activity.basket import get_products_in_basket
+from activity.basket import get_products_in_basket, basket_owner, basket_product_owner, invalidate_basket_count, forget_committed_basket_counts, read_basket_changes, apply_basket_changes
 from activity.addProduct import add_product_invoke
 from activity.register import register_user
 from activity.login import login_in
-from activity.payment import process_checkout_or_generate_alerts
-from activity.webhook import invoke_webhook
+from activity.payment import process_checkout_or_generate_alerts, cancel_checkout
+from activity.webhook import invoke_webhook, SHORTAGE_STATUS
 from activity.editProduct import invoke_edit_product
 from activity.deleteCategory import invoke_delete_category
 from activity.deleteProduct import invoke_delete_product
 from activity.success import delete_all_basket_products
+from activity.categories import get_category_choices, get_category_names, add_category as create_category
+from activity.image import invoke_product_image
+from activity.catalog import select_warehouse_products, paginate_keyset, read_page_request, page_url, serialize_product
+from activity.thumbnails import IMAGE_VARIANTS, product_srcset
+from activity.reports import read_report_range, get_sales_report
 from decorators import get_data, manage_product, see_ware_house
+from worker import submit_webhook_event
 
-def init_routes(app, login_manager, db, endpoint_secret):
+def init_routes(app, login_manager, db, gateway):
+    @app.after_request
+    def commit_request(response):
+        # One transaction per request: activity functions only flush, and the
+        # work of a successful request is committed here, once
+        if response.status_code < 400:
+            db.session.commit()
+            forget_committed_basket_counts()
+        else:
+            db.session.rollback()
+        return response
+    app.jinja_env.globals["product_srcset"] = lambda product: product_srcset(url_for, product)
     @login_manager.user_loader
     def load_user(user_id):
         return db.get_or_404(User, user_id)
@@ -35,29 +50,37 @@ def init_routes(app, login_manager, db, endpoint_secret):
     @app.route("/products")
     @get_data
     def products_page(**kwargs):
-        products, value, category_id, categories = get_products(db, request)
+        page, filters, categories = get_products(db, request, app.config["CATALOG_PAGE_SIZE"])
         content = {
             "logged_in": current_user.is_authenticated,
-            "products": products,
-            "b64encode": b64encode,
+            "products": page.items,
+            "next_url": page.next_cursor and page_url(url_for, "products_page", request.args, after=page.next_cursor),
+            "prev_url": page.prev_cursor and page_url(url_for, "products_page", request.args, before=page.prev_cursor),
             "amount": kwargs["amount"],
             "categories": categories,
-            "category_value": category_id,
-            "valuee": value
-
+            "category_names": get_category_names(db),
+            "filters": filters
         }
         template = "products.html"
         return render_template(template, **content)
+    @app.route("/api/products")
+    def products_api():
+        page, filters, categories = get_products(db, request, app.config["CATALOG_PAGE_SIZE"])
+        return jsonify(
+            items=[serialize_product(url_for, product, get_category_names(db)) for product in page.items],
+            next=page.next_cursor and page_url(url_for, "products_api", request.args, after=page.next_cursor),
+            prev=page.prev_cursor and page_url(url_for, "products_api", request.args, before=page.prev_cursor)
+        )
     @app.route("/oneProduct/<int:num>", methods=["POST", "GET"])
     @get_data
     def one_product(num, **kwargs):
-        product = db.get_or_404(Product, num)
         if request.method == "POST":
             get_product(db, num, current_user, session, request, redirect)
+            invalidate_basket_count(basket_owner(current_user, session))
             return redirect(request.referrer)
+        product = db.get_or_404(Product, num)
         content = {
             "logged_in": current_user.is_authenticated,
-            "b64encode": b64encode,
             "product": product,
             "amount": kwargs["amount"],
             "is_product": check_if_is_product(product, session, db, current_user)
@@ -75,15 +98,23 @@ def init_routes(app, login_manager, db, endpoint_secret):
         content = {
             "logged_in": current_user.is_authenticated,
             "basket_products": products,
-            "b64encode": b64encode,
             "amount": kwargs["amount"]
         }
         return render_template(template, **content)
+    @app.route("/images/<int:product_id>")
+    @app.route("/images/<int:product_id>/<size>")
+    def product_image(product_id, size=None):
+        if size is not None and size not in IMAGE_VARIANTS:
+            return abort(404)
+        response = invoke_product_image(db, product_id, request, app.config["IMAGE_CACHE_MAX_AGE"], size)
+        if response is None:
+            return abort(404)
+        return response
     @app.route("/delete/<int:num>")
     def delete_basket(num):
         product = db.get_or_404(BasketProduct, num)
         db.session.delete(product)
-        db.session.commit()
+        invalidate_basket_count(basket_product_owner(product))
         return redirect(request.referrer)
     @app.route("/addProduct", methods=["POST", "GET"])
     @login_required
@@ -91,8 +122,7 @@ def init_routes(app, login_manager, db, endpoint_secret):
     @get_data
     def add_product(**kwargs):
         form = FormProduct()
-        categories = db.session.execute(db.select(Category)).scalars().all()
-        form.category.choices = [(category.name, category.name) for category in categories]
+        form.category.choices = get_category_choices(db)
         if form.validate_on_submit():
             add_product_invoke(form, db, current_user)
             return redirect(url_for("products_page"))
@@ -110,10 +140,7 @@ def init_routes(app, login_manager, db, endpoint_secret):
     def add_category(**kwargs):
         form = InputCategory()
         if form.validate_on_submit():
-            name = form.name.data
-            new_category = Category(name=name)
-            db.session.add(new_category)
-            db.session.commit()
+            create_category(db, form.name.data)
             return redirect(url_for("products_page"))
         content = {
             "form": form,
@@ -127,7 +154,7 @@ def init_routes(app, login_manager, db, endpoint_secret):
     def register(**kwargs):
         alerts = []
         if request.method == "POST":
-            x, y = register_user(request, db, alerts, login_user, generate_password_hash)
+            x, y = register_user(request, db, alerts, login_user, generate_password_hash, session)
             if x == 1:
                 alerts = y
             else:
@@ -144,7 +171,7 @@ def init_routes(app, login_manager, db, endpoint_secret):
     def login(**kwargs):
         alert = ""
         if request.method == "POST":
-            x, y = login_in(request, login_user, check_password_hash, db)
+            x, y = login_in(request, login_user, check_password_hash, db, session)
             if x == 1:
               alert = y
             else:
@@ -165,7 +192,7 @@ def init_routes(app, login_manager, db, endpoint_secret):
         basket_product = db.get_or_404(BasketProduct, num)
         if basket_product.amount + 1 <= basket_product.product.amount:
             basket_product.amount = basket_product.amount + 1
-            db.session.commit()
+            invalidate_basket_count(basket_product_owner(basket_product))
         return redirect(request.referrer)
     @app.route("/deleteOne/<int:num>")
     def delete_one(num):
@@ -173,18 +200,30 @@ def init_routes(app, login_manager, db, endpoint_secret):
         basket_product.amount = basket_product.amount - 1
         if basket_product.amount == 0:
             db.session.delete(basket_product)
-        db.session.commit()
+        invalidate_basket_count(basket_product_owner(basket_product))
         return redirect(request.referrer)
     @app.route("/deleteBasketProduct/<int:num>")
     def delete_basket_product(num):
         basket_product = db.get_or_404(BasketProduct, num)
         db.session.delete(basket_product)
-        db.session.commit()
+        invalidate_basket_count(basket_product_owner(basket_product))
         return redirect(request.referrer)
+    @app.route("/api/basket", methods=["POST"])
+    def basket_api():
+        # Only application/json bodies are read, which a cross-site form cannot send
+        changes = read_basket_changes(request.get_json(silent=True))
+        if changes is None:
+            return jsonify(error="Expected {\"changes\": [{\"id\": <line>, \"amount\": <quantity>}]}"), 400
+        x, y = apply_basket_changes(db, basket_owner(current_user, session), changes)
+        if x == 1:
+            return jsonify(error="Basket line not found"), 404
+        return jsonify(y)
     @app.route("/pay")
     @get_data
-    def pay(**kwargs):
-        x, y = process_checkout_or_generate_alerts(current_user, db, session, stripe)
+    async def pay(**kwargs):
+        # Under WSGI the worker thread still waits for Stripe; the call itself goes
+        # through the gateway's pooled httpx client (needs Flask[async])
+        x, y = await process_checkout_or_generate_alerts(current_user, db, session, gateway, app.config["CHECKOUT_SESSION_TTL"])
         if x == 0:
             checkout_session = y
             return redirect(checkout_session['url'], code=303)
@@ -198,16 +237,19 @@ def init_routes(app, login_manager, db, endpoint_secret):
             return render_template(template, logged_in=current_user.is_authenticated, alerts=alerts, amount=kwargs["amount"])
     @app.route('/webhook', methods=['POST'])
     def webhook():
-        invoke_webhook(request, stripe, endpoint_secret, db)
+        event_id = invoke_webhook(request, gateway, db)
+        submit_webhook_event(app, db, event_id)
         return jsonify(success=True)
     @app.route("/warehouse")
     @login_required
     @see_ware_house
     @get_data
     def store(**kwargs):
-        products = db.session.execute(db.select(Product)).scalars().all()
+        page = paginate_keyset(db, select_warehouse_products(db), Product.id, **read_page_request(request, app.config["WAREHOUSE_PAGE_SIZE"]))
         content = {
-            "products": products,
+            "products": page.items,
+            "next_url": page.next_cursor and page_url(url_for, "store", request.args, after=page.next_cursor),
+            "prev_url": page.prev_cursor and page_url(url_for, "store", request.args, before=page.prev_cursor),
             "amount": kwargs["amount"],
             "logged_in": current_user.is_authenticated
         }
@@ -218,7 +260,9 @@ def init_routes(app, login_manager, db, endpoint_secret):
     @see_ware_house
     @get_data
     def orders_page(**kwargs):
-        orders = db.session.execute(db.select(Order).where(Order.status == "to_implement")).scalars().all()
+        orders = db.session.execute(
+            db.select(Order).where(Order.status.in_(("to_implement", SHORTAGE_STATUS))).options(db.selectinload(Order.items))
+        ).scalars().all()
         content = {
             "orders": orders,
             "amount": kwargs["amount"],
@@ -231,7 +275,9 @@ def init_routes(app, login_manager, db, endpoint_secret):
     @see_ware_house
     @get_data
     def complete_orders_page(**kwargs):
-        orders = db.session.execute(db.select(Order).where(Order.status == "complete")).scalars().all()
+        orders = db.session.execute(
+            db.select(Order).where(Order.status == "complete").options(db.selectinload(Order.items))
+        ).scalars().all()
         content = {
             "orders": orders,
             "amount": kwargs["amount"],
@@ -239,19 +285,42 @@ def init_routes(app, login_manager, db, endpoint_secret):
         }
         template = "completeOrders.html"
         return render_template(template, **content)
+    @app.route("/reports")
+    @login_required
+    @see_ware_house
+    @get_data
+    def reports_page(**kwargs):
+        start, end = read_report_range(request)
+        content = {
+            "report": get_sales_report(db, start, end),
+            "amount": kwargs["amount"],
+            "logged_in": current_user.is_authenticated
+        }
+        template = "reports.html"
+        return render_template(template, **content)
+    @app.route("/api/reports/sales")
+    @login_required
+    @see_ware_house
+    def sales_report_api():
+        start, end = read_report_range(request)
+        return jsonify(get_sales_report(db, start, end))
     @app.route("/editProduct/<int:num>", methods=["POST", "GET"])
     @login_required
     @manage_product
     @get_data
     def edit_item(num, **kwargs):
         product = db.get_or_404(Product, num)
-        categories = db.session.execute(db.select(Category)).scalars().all()
-        form = FormProductForEdit(name=product.name, description=product.description, price=product.price, amount=product.amount, location=product.location, category=product.category)
-        form.category.choices = [(category.name, category.name) for category in categories]
+        form = FormProductForEdit(name=product.name, description=product.description, price=product.price, amount=product.amount, amount_seen=product.amount, location=product.location, category=get_category_names(db).get(product.category_id))
+        form.category.choices = get_category_choices(db)
+        alerts = []
         if form.validate_on_submit():
-            invoke_edit_product(db, product.id, form)
+            alerts = invoke_edit_product(db, product.id, form)
+            if not alerts:
+                # The next edit starts from the amount just saved
+                form.amount.data = form.amount_seen.data = product.amount
         content = {
             "form": form,
+            "alerts": alerts,
             "logged_in": current_user.is_authenticated,
             "amount": kwargs["amount"]
         }
@@ -264,8 +333,7 @@ def init_routes(app, login_manager, db, endpoint_secret):
     def delete_category(**kwargs):
         alerts = []
         form = DeleteCategoryForm()
-        categories = db.session.execute(db.select(Category)).scalars().all()
-        form.name.choices = [(category.name, category.name) for category in categories]
+        form.name.choices = get_category_choices(db)
         if form.validate_on_submit():
             x, alerts = invoke_delete_category(db, form)
             if x == 0:
@@ -290,12 +358,12 @@ def init_routes(app, login_manager, db, endpoint_secret):
     def implement_order(num):
         order = db.get_or_404(Order, num)
         order.status = "complete"
-        db.session.commit()
         return redirect(request.referrer)
     @app.route("/success")
     @get_data
     def success_page(**kwargs):
         x = delete_all_basket_products(db, session, current_user)
+        invalidate_basket_count(basket_owner(current_user, session))
         if x == 0:
             return abort(404)
         content = {
@@ -307,6 +375,10 @@ def init_routes(app, login_manager, db, endpoint_secret):
     @app.route("/denied")
     @get_data
     def deny_page(**kwargs):
+        # Stripe sends the customer back here on cancel; hand the reserved stock back
+        token = request.args.get("reservation")
+        if token:
+            cancel_checkout(db, gateway, token)
         content = {
             "logged_in": current_user.is_authenticated,
             "amount": kwargs["amount"]
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from housekeeping import format_report, run_housekeeping
+
+SCHEDULER_KEY = "scheduler"
+
+
+def run_job(app, name, job):
+    """
+    Runs one scheduled job inside an application context, logging failures.
+
+    Parameters:
+    app: The Flask application.
+    name: The job name, for the logs.
+    job: A callable without arguments.
+
+    Returns:
+    None
+    """
+    with app.app_context():
+        try:
+            job()
+        except Exception:
+            app.logger.exception("Scheduled job %s failed", name)
+
+
+def start_scheduler(app, jobs):
+    """
+    Starts a daemon thread running periodic jobs in this process.
+
+    Only the process started with RUN_SCHEDULER=1 (or the development
+    server) runs it, never CLI commands or every worker of a multi-process
+    server. The jobs stay safe to run concurrently with `flask housekeeping`
+    from cron. The first run of each job happens one interval after startup.
+
+    Parameters:
+    app: The Flask application.
+    jobs: A list of (name, interval_seconds, callable) tuples.
+
+    Returns:
+    A threading.Event; setting it stops the scheduler.
+    """
+    stop = threading.Event()
+    next_runs = {name: time.monotonic() + interval for name, interval, job in jobs}
+
+    def loop():
+        while not stop.is_set():
+            now = time.monotonic()
+            for name, interval, job in jobs:
+                if next_runs[name] <= now:
+                    run_job(app, name, job)
+                    next_runs[name] = time.monotonic() + interval
+            stop.wait(max(min(next_runs.values()) - time.monotonic(), 1))
+
+    threading.Thread(target=loop, name="scheduler", daemon=True).start()
+    app.extensions[SCHEDULER_KEY] = stop
+    return stop
+
+
+def start_housekeeping(app, db):
+    """
+    Starts the periodic housekeeping job in this process, once.
+
+    Parameters:
+    app: The Flask application.
+    db: The database object.
+
+    Returns:
+    The stop Event of the scheduler, or None when HOUSEKEEPING_INTERVAL is 0.
+    """
+    if app.config["HOUSEKEEPING_INTERVAL"] <= 0:
+        return None
+    if SCHEDULER_KEY in app.extensions:
+        return app.extensions[SCHEDULER_KEY]
+    return start_scheduler(app, [
+        ("housekeeping", app.config["HOUSEKEEPING_INTERVAL"],
+         lambda: app.logger.info(format_report(run_housekeeping(db, app.config)))),
+    ])
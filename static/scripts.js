@@ -1 +1,88 @@
-new DataTable('#example');
\ No newline at end of file
+if (document.querySelector('#example')) {
+    new DataTable('#example');
+}
+
+// Basket quantity buttons: changes made within BASKET_BATCH_DELAY ms are sent
+// together to /api/basket, and only the numbers on the page are updated.
+// Without JavaScript the links still work as plain page loads.
+(function () {
+    var BASKET_BATCH_DELAY = 300;
+    var pending = {};
+    var timer = null;
+
+    function lineOf(element) {
+        return element.closest('[data-basket-line]');
+    }
+
+    function setAmount(line, amount) {
+        line.dataset.amount = amount;
+        line.querySelector('[data-basket-amount]').textContent = amount;
+    }
+
+    function flush() {
+        timer = null;
+        var changes = Object.keys(pending).map(function (id) {
+            return {id: parseInt(id, 10), amount: pending[id]};
+        });
+        pending = {};
+        if (!changes.length) {
+            return;
+        }
+        fetch(window.BASKET_API_URL, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            credentials: 'same-origin',
+            body: JSON.stringify({changes: changes})
+        }).then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        }).then(function (result) {
+            result.lines.forEach(function (change) {
+                var line = document.querySelector('[data-basket-line="' + change.id + '"]');
+                if (!line) {
+                    return;
+                }
+                if (change.amount === 0) {
+                    line.remove();
+                    return;
+                }
+                setAmount(line, change.amount);
+                line.querySelector('[data-basket-total]').textContent = 'PLN ' + change.total;
+            });
+            document.querySelectorAll('.cart-count').forEach(function (badge) {
+                badge.textContent = result.count;
+            });
+            if (!document.querySelector('[data-basket-line]')) {
+                window.location.reload();  // Show the empty basket page
+            }
+        }).catch(function () {
+            window.location.reload();  // Fall back to the server's view of the basket
+        });
+    }
+
+    function queue(line, amount) {
+        amount = Math.max(amount, 0);
+        pending[line.dataset.basketLine] = amount;
+        setAmount(line, amount);
+        clearTimeout(timer);
+        timer = setTimeout(flush, BASKET_BATCH_DELAY);
+    }
+
+    document.addEventListener('click', function (event) {
+        if (!window.BASKET_API_URL) {
+            return;
+        }
+        var delta = event.target.closest('[data-basket-delta]');
+        var remove = event.target.closest('[data-basket-remove]');
+        if (delta && lineOf(delta)) {
+            event.preventDefault();
+            var line = lineOf(delta);
+            queue(line, parseInt(line.dataset.amount, 10) + parseInt(delta.dataset.basketDelta, 10));
+        } else if (remove && lineOf(remove)) {
+            event.preventDefault();
+            queue(lineOf(remove), 0);
+        }
+    });
+})();
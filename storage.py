@@ -0,0 +1,141 @@
+import hashlib
+import os
+import tempfile
+
+from flask import current_app
+from sqlalchemy import inspect, text
+
+
+def image_store_root():
+    """
+    Returns the directory of the content-addressed image store.
+
+    Returns:
+    The absolute path configured as IMAGE_STORE_PATH.
+    """
+    return current_app.config["IMAGE_STORE_PATH"]
+
+
+def blob_path(digest, root=None):
+    """
+    Maps a content hash to its file path, fanned out over two directory levels.
+
+    Parameters:
+    digest: The SHA-256 hex digest of the blob.
+    root: The store directory (defaults to IMAGE_STORE_PATH).
+
+    Returns:
+    The path of the blob file, e.g. <root>/ab/cd/abcd....
+    """
+    root = root or image_store_root()
+    return os.path.join(root, digest[:2], digest[2:4], digest)
+
+
+def store_blob(data, root=None):
+    """
+    Writes bytes into the content-addressed store, unless an identical blob already exists.
+
+    The file is written to a temporary name and renamed into place, so a
+    concurrent reader never sees a partially written image.
+
+    Parameters:
+    data: The bytes to store.
+    root: The store directory (defaults to IMAGE_STORE_PATH).
+
+    Returns:
+    The SHA-256 hex digest identifying the blob.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest, root)
+    if os.path.exists(path):
+        try:
+            # Reused blobs count as new, so housekeeping doesn't sweep one before its row commits
+            os.utime(path)
+        except FileNotFoundError:
+            pass  # Swept meanwhile; write it again
+        else:
+            return digest  # Deduplicated: same content, same file
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return digest
+
+
+def read_blob(digest, root=None):
+    """
+    Reads a blob back from the store.
+
+    Parameters:
+    digest: The SHA-256 hex digest of the blob.
+    root: The store directory (defaults to IMAGE_STORE_PATH).
+
+    Returns:
+    The stored bytes.
+    """
+    with open(blob_path(digest, root), "rb") as blob_file:
+        return blob_file.read()
+
+
+def move_table_blobs_to_store(db, table, batch_size=100):
+    """
+    Moves the inline `image` column of a table into the store, leaving `image_hash` behind.
+
+    Safe to re-run: rows that already have a hash are skipped and the
+    `image` column is only dropped once every row has been copied. Not
+    committed; the caller commits the whole move at once.
+
+    Parameters:
+    db: The database object.
+    table: The table name ("products" or "productImageVariants").
+    batch_size: How many rows are read into memory at a time.
+
+    Returns:
+    The number of rows moved.
+    """
+    columns = {column["name"] for column in inspect(db.session.connection()).get_columns(table)}
+    if "image" not in columns:
+        return 0
+    if "image_hash" not in columns:
+        db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN image_hash VARCHAR(64)'))
+
+    moved = 0
+    while True:
+        rows = db.session.execute(
+            text(f'SELECT id, image FROM "{table}" WHERE image_hash IS NULL LIMIT :limit'),
+            {"limit": batch_size}
+        ).all()
+        if not rows:
+            break
+        for row_id, image in rows:
+            db.session.execute(
+                text(f'UPDATE "{table}" SET image_hash = :digest WHERE id = :id'),
+                {"digest": store_blob(image), "id": row_id}
+            )
+        moved += len(rows)
+
+    db.session.execute(text(f'ALTER TABLE "{table}" DROP COLUMN image'))
+    return moved
+
+
+def migrate_images_to_store(db):
+    """
+    One-off migration moving every product image blob out of the database. Not committed.
+
+    Parameters:
+    db: The database object.
+
+    Returns:
+    A dict mapping table name to the number of rows moved.
+    """
+    return {
+        table: move_table_blobs_to_store(db, table)
+        for table in ("products", "productImageVariants")
+        if inspect(db.session.connection()).has_table(table)
+    }
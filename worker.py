@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from activity.webhook import process_webhook_event
+
+WEBHOOK_EXECUTOR_KEY = "webhook_executor"
+
+
+def init_webhook_worker(app):
+    """
+    Creates the thread pool that processes stored webhook events.
+
+    The pool is bounded by WEBHOOK_WORKERS; with 0 workers events are
+    processed inline by submit_webhook_event.
+
+    Parameters:
+    app: The Flask application.
+
+    Returns:
+    The ThreadPoolExecutor, or None when processing is inline.
+    """
+    workers = app.config["WEBHOOK_WORKERS"]
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook") if workers > 0 else None
+    app.extensions[WEBHOOK_EXECUTOR_KEY] = executor
+    return executor
+
+
+def run_webhook_event(app, db, event_id):
+    """
+    Processes one stored event inside its own application context.
+
+    Parameters:
+    app: The Flask application.
+    db: The database object.
+    event_id: The Stripe event id.
+
+    Returns:
+    bool: True if the event was processed by this call.
+    """
+    with app.app_context():
+        try:
+            return process_webhook_event(db, event_id)
+        except Exception:
+            app.logger.exception("Processing webhook event %s failed", event_id)
+            db.session.rollback()
+            return False
+
+
+def submit_webhook_event(app, db, event_id):
+    """
+    Hands a stored event to the worker pool and returns immediately.
+
+    Parameters:
+    app: The Flask application.
+    db: The database object.
+    event_id: The Stripe event id.
+
+    Returns:
+    None
+    """
+    executor = app.extensions.get(WEBHOOK_EXECUTOR_KEY)
+    if executor is None:
+        run_webhook_event(app, db, event_id)
+    else:
+        executor.submit(run_webhook_event, app, db, event_id)
+
+
+def replay_webhook_events(app, db, event_ids, workers):
+    """
+    Processes a batch of stored events with a dedicated pool and waits for it.
+
+    Events that are already processed, or claimed by another worker, are
+    skipped, so a replay can safely run next to the live pool.
+
+    Parameters:
+    app: The Flask application.
+    db: The database object.
+    event_ids: The Stripe event ids to process, in order.
+    workers: How many events are processed concurrently.
+
+    Returns:
+    int: The number of events processed by this replay.
+    """
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="webhook-replay") as executor:
+        results = executor.map(lambda event_id: run_webhook_event(app, db, event_id), event_ids)
+        return sum(1 for processed in results if processed)